@@ -0,0 +1,259 @@
+### Python lib
+import os
+import json
+import copy
+import shutil
+import hashlib
+import functools
+import multiprocessing
+import scipy as sp
+
+from . import cache, correlation_3D
+
+### Arrays of the raw sums, see correlation_3D.read_sums_from_do_cor
+sums_arrays = ['WE','WDA','WRP','WRT','WZ','NB']
+
+def save_sums(path,sums):
+    '''
+        Save the arrays of the raw sums in the .npz file path
+    '''
+
+    tmp = path+'.tmp'+str(os.getpid())+'.npz'
+    arrays = { k:sums[k] for k in sums_arrays if sums[k] is not None }
+    sp.savez(tmp,**arrays)
+    os.rename(tmp,path)
+
+    return
+def load_sums(path,head):
+
+    with sp.load(path) as f:
+        sums = { k:(f[k] if k in f.files else None) for k in sums_arrays }
+    sums['head'] = head
+
+    return sums
+def read_sums(path,read_da=True,block_size=None):
+    '''
+        Identity and raw sums of the do_cor file at path
+    '''
+
+    identity = cache.file_identity(path)
+    sums = correlation_3D.read_sums_from_do_cor(path,read_da=read_da,block_size=block_size)
+
+    return path, identity, sums
+
+class Accumulator:
+    '''
+        Raw sums of do_cor files persisted in directory, updated
+        with only the new or changed files.
+        The directory holds:
+            - manifest.json: grid, and identity of each ingested file
+            - total-<generation>.npz: sum of the raw sums of all the ingested files
+            - files/: raw sums of each ingested file, from which the total
+              is rebuilt if a file changes or is removed
+        The raw sums are those of correlation_3D.read_sums_from_do_cor.
+        The files referenced by the manifest are never overwritten, and the
+        manifest is replaced last, so that an interrupted update leaves
+        the previous state
+    '''
+
+    def __init__(self,directory,dic=None):
+
+        if dic is None:
+            dic = copy.deepcopy(correlation_3D.raw_dic_class)
+
+        self._directory = os.path.expandvars(directory)
+        self._dic = dic
+        self._read_da = dic['correlation'] not in ['o_o','o1_o2']
+
+        self._manifest = {'head':None, 'read_da':self._read_da, 'generation':0, 'files':{}}
+        self._total = None
+        self._obsolete = []
+        self._rebuild = False
+
+        if not os.path.isdir(os.path.join(self._directory,'files')):
+            os.makedirs(os.path.join(self._directory,'files'))
+
+        path = os.path.join(self._directory,'manifest.json')
+        if os.path.isfile(path):
+            with open(path) as f:
+                self._manifest = json.load(f)
+            assert(self._manifest['read_da']==self._read_da)
+            if len(self._manifest['files'])>0:
+                self._total = load_sums(self.get_total(),self._manifest['head'])
+
+        return
+
+    def __len__(self):
+
+        return len(self._manifest['files'])
+    def get_entry(self,path,identity):
+        '''
+            File of the raw sums of the do_cor file at path, with identity
+        '''
+
+        s = json.dumps([path,identity],sort_keys=True)
+        name = hashlib.sha1(s.encode('utf-8')).hexdigest()+'.npz'
+
+        return os.path.join(self._directory,'files',name)
+    def get_total(self,generation=None):
+        '''
+            File of the total raw sums
+        '''
+
+        if generation is None:
+            generation = self._manifest['generation']
+
+        return os.path.join(self._directory,'total-'+str(generation)+'.npz')
+    def get_changed(self,paths):
+        '''
+            Files of paths that are not ingested, or changed since ingested
+        '''
+
+        changed = []
+        for p in paths:
+            p = os.path.abspath(os.path.expandvars(p))
+            if p not in self._manifest['files'] or self._manifest['files'][p]!=cache.file_identity(p):
+                changed += [p]
+
+        return changed
+    def add(self,path,identity,sums):
+        '''
+            Add the raw sums of a file, replacing its previous contribution
+        '''
+
+        if self._manifest['head'] is None:
+            self._manifest['head'] = sums['head']
+        assert(self._manifest['head']==sums['head'])
+
+        ### A replaced file makes the total rebuilt from the entries when saved
+        entry = self.get_entry(path,identity)
+        if path in self._manifest['files']:
+            previous = self.get_entry(path,self._manifest['files'][path])
+            if previous!=entry:
+                self._obsolete += [previous]
+            self._rebuild = True
+        if not self._rebuild:
+            if self._total is None:
+                self._total = sums
+            else:
+                self._total = correlation_3D.add_sums(self._total,sums)
+
+        save_sums(entry,sums)
+        self._manifest['files'][path] = identity
+
+        return
+    def remove(self,paths):
+        '''
+            Remove the contribution of the files in paths
+        '''
+
+        for p in paths:
+            p = os.path.abspath(os.path.expandvars(p))
+            if p not in self._manifest['files']:
+                continue
+            self._obsolete += [self.get_entry(p,self._manifest['files'][p])]
+            self._rebuild = True
+            del self._manifest['files'][p]
+
+        self.save()
+
+        return
+    def update(self,paths,workers=1,block_size=None,remove_missing=False):
+        '''
+            Ingest the new or changed files of paths, read in parallel
+            by workers processes, and save the state.
+            If remove_missing, the ingested files not in paths are removed.
+            Return the list of the ingested files
+        '''
+
+        changed = self.get_changed(paths)
+        read = functools.partial(read_sums,read_da=self._read_da,block_size=block_size)
+
+        pool = None
+        try:
+            if workers>1 and len(changed)>1:
+                pool = multiprocessing.Pool(workers)
+                results = pool.imap_unordered(read,changed)
+            else:
+                results = ( read(p) for p in changed )
+            for path, identity, sums in results:
+                self.add(path,identity,sums)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            ### Save the files ingested so far, even if a read failed,
+            ### so that their entries are in the manifest
+            self.save()
+
+        if remove_missing:
+            paths = set( os.path.abspath(os.path.expandvars(p)) for p in paths )
+            self.remove([ p for p in self._manifest['files'] if p not in paths ])
+
+        return changed
+    def rebuild(self):
+        '''
+            Sum the raw sums of the entries of all the ingested files.
+            Used when a file is replaced or removed, rather than subtracting
+            its contribution, which would leave rounding residues in the
+            weights of the bins it was the only one to fill
+        '''
+
+        head = self._manifest['head']
+        files = sorted(self._manifest['files'].items())
+        self._total = correlation_3D.tree_sum( load_sums(self.get_entry(p,i),head) for p, i in files )
+        self._rebuild = False
+
+        return
+    def save(self):
+        '''
+            Save the total raw sums in a new generation, then the manifest,
+            and remove the previous total and the replaced entries
+        '''
+
+        if self._rebuild:
+            self.rebuild()
+
+        previous = self.get_total()
+        self._manifest['generation'] += 1
+        if self._total is not None:
+            save_sums(self.get_total(),self._total)
+
+        path = os.path.join(self._directory,'manifest.json')
+        tmp = path+'.tmp'+str(os.getpid())
+        with open(tmp,'w') as f:
+            json.dump(self._manifest,f,indent=1)
+        os.rename(tmp,path)
+
+        for entry in self._obsolete+[previous]:
+            if os.path.isfile(entry):
+                os.remove(entry)
+        self._obsolete = []
+
+        return
+    def get_correlation(self,dic=None):
+        '''
+            Correlation3D of all the ingested files, built with the entries
+            of dic (default: the one of the accumulator)
+        '''
+
+        if self._total is None:
+            return None
+        if dic is None:
+            dic = self._dic
+
+        dic = copy.copy(dic)
+        dic['read'] = 'read_from_sums'
+        dic['path'] = self._total
+
+        return correlation_3D.Correlation3D(dic)
+    def clear(self):
+
+        shutil.rmtree(self._directory,ignore_errors=True)
+        os.makedirs(os.path.join(self._directory,'files'))
+        self._manifest = {'head':None, 'read_da':self._read_da, 'generation':0, 'files':{}}
+        self._total = None
+        self._obsolete = []
+        self._rebuild = False
+
+        return
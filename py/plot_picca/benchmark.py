@@ -0,0 +1,389 @@
+### Python lib
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import copy
+import argparse
+import tempfile
+import platform
+import tracemalloc
+import subprocess
+import numpy
+import scipy as sp
+import scipy.linalg
+
+from . import utils
+
+fitsio = utils.LazyModule('fitsio')
+h5py   = utils.LazyModule('h5py')
+
+### Modules of the package, and dependencies that a data-only import should not load
+modules = ['utils','correlation_1D','correlation_3D','correlation_3D_angl','fit']
+heavy_dependencies = ['matplotlib','fitsio','h5py','picca']
+
+### Import-time budget in seconds
+import_time_budget = 1.
+
+### Default sizes of the synthetic files
+raw_dic_sizes = {
+    'n_healpix'   : 100,
+    'np'          : 50,
+    'nt'          : 50,
+    'n1d'         : 1000,
+    'npar'        : 10,
+    'niterations' : 1000,
+}
+
+def import_time(module,budget=import_time_budget):
+    '''
+        Time to import plot_picca.module in a new interpreter,
+        and heavy dependencies loaded by this import
+    '''
+
+    code = '''
+import sys, time, json
+t0 = time.time()
+import plot_picca.{}
+t1 = time.time()
+print(json.dumps({{'time':t1-t0, 'loaded':[ m for m in {} if m in sys.modules ]}}))
+'''.format(module,heavy_dependencies)
+
+    env = dict(os.environ)
+    path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = path+os.pathsep+env.get('PYTHONPATH','')
+    out = subprocess.check_output([sys.executable,'-c',code],env=env)
+    res = json.loads(out.decode('utf-8').strip().split('\n')[-1])
+    res['module'] = module
+    res['budget'] = budget
+    res['ok'] = (res['time']<=budget) and (len(res['loaded'])==0)
+
+    return res
+def run_import_time(budget=import_time_budget):
+
+    return [ import_time(m,budget) for m in modules ]
+
+### Synthetic files, in the layouts written by picca
+def get_grid(np,nt,rpmin=0.,rpmax=200.,rtmax=200.):
+    '''
+        Header and centers of the (rp,rt) bins, rt varying fastest
+    '''
+
+    head = {'NP':np, 'NT':nt, 'RPMIN':rpmin, 'RPMAX':rpmax, 'RTMAX':rtmax}
+    index = sp.arange(np*nt)
+    rp = rpmin+(index//nt+0.5)*(rpmax-rpmin)/np
+    rt = (index%nt+0.5)*rtmax/nt
+
+    return head, rp, rt
+def get_model(rp,rt):
+    '''
+        Smooth correlation with a BAO-like bump
+    '''
+
+    r = sp.sqrt(rp**2+rt**2)
+    mu = rp/sp.maximum(r,1.)
+
+    return (1.+0.5*mu**2)*(0.1/(1.+(r/10.)**2) + 0.002*sp.exp(-(r-105.)**2/(2.*8.**2)))
+def get_covariance(rp,rt,sigma=1.e-4,length=8.):
+    '''
+        Positive definite covariance, decreasing with the (rp,rt) separation
+    '''
+
+    drp = rp[:,None]-rp[None,:]
+    drt = rt[:,None]-rt[None,:]
+    co = sigma**2*sp.exp(-(drp**2+drt**2)/(2.*length**2))
+    co[sp.diag_indices_from(co)] *= 2.
+
+    return co
+def write_do_cor(path,n_healpix,np,nt,seed=0):
+    '''
+        do_cor file: grid in HDU 1, and per-HEALPix WE and DA in HDU 2
+    '''
+
+    rng = numpy.random.RandomState(seed)
+    head, rp, rt = get_grid(np,nt)
+    nbins = np*nt
+
+    z  = 2.3+0.01*rng.randn(nbins)
+    nb = rng.randint(1000,10000,size=nbins).astype('i8')
+    we = rng.uniform(0.,1.,size=(n_healpix,nbins))
+    da = get_model(rp,rt)+0.01*rng.randn(n_healpix,nbins)/sp.sqrt(we+0.1)
+
+    out = fitsio.FITS(path,'rw',clobber=True)
+    out.write([rp,rt,z,nb],names=['RP','RT','Z','NB'],header=head,extname='ATTRI')
+    out.write([sp.arange(n_healpix),we,da],names=['HEALPID','WE','DA'],extname='COR')
+    out.close()
+
+    return
+def write_export(path,np,nt,seed=0):
+    '''
+        Exported correlation: grid, DA, CO, DM and NB in HDU 1
+    '''
+
+    rng = numpy.random.RandomState(seed)
+    head, rp, rt = get_grid(np,nt)
+    nbins = np*nt
+
+    z  = 2.3+0.01*rng.randn(nbins)
+    nb = rng.randint(1000,10000,size=nbins).astype('i8')
+    co = get_covariance(rp,rt)
+    da = get_model(rp,rt)+sp.linalg.cholesky(co,lower=True).dot(rng.randn(nbins))
+
+    ### Distortion matrix, mixing each bin with its neighbours along rt
+    dm = sp.identity(nbins)
+    i = sp.arange(nbins-1)
+    dm[i,i+1] = -0.1
+    dm[i+1,i] = -0.1
+
+    out = fitsio.FITS(path,'rw',clobber=True)
+    out.write([rp,rt,z,da,co,dm,nb],names=['RP','RT','Z','DA','CO','DM','NB'],header=head,extname='COR')
+    out.close()
+
+    return
+def get_grid_1d(n1d,llmin=3.56,dll=3.e-4):
+    '''
+        Header of the wavelength grid of n1d bins.
+        LLMAX is half a bin above the last one, for the number of bins
+        read back by int((LLMAX-LLMIN)/DLL+1) not to be truncated to n1d-1
+    '''
+
+    return {'LLMIN':llmin, 'LLMAX':llmin+(n1d-0.5)*dll, 'DLL':dll}
+def write_do_cor_1d(path,n1d,seed=0,llmin=3.56,dll=3.e-4):
+    '''
+        1D do_cor file: wavelength grid in the header of HDU 1,
+        and the upper triangle of the DA, WE and NB matrices in HDU 2
+    '''
+
+    rng = numpy.random.RandomState(seed)
+    head = get_grid_1d(n1d,llmin,dll)
+
+    i = sp.arange(n1d)
+    upper = (i[None,:]>=i[:,None])
+    we = sp.where(upper,rng.uniform(0.5,1.,size=(n1d,n1d)),0.)
+    da = sp.where(upper,0.1*sp.exp(-(i[None,:]-i[:,None])/50.)+0.001*rng.randn(n1d,n1d),0.)
+    nb = sp.where(upper,rng.randint(100,1000,size=(n1d,n1d)),0).astype('i8')
+
+    out = fitsio.FITS(path,'rw',clobber=True)
+    out.write([sp.zeros(1)],names=['DUMMY'],header=head,extname='ATTRI')
+    out.write([da,we,nb],names=['DA','WE','NB'],extname='MULT')
+    out.close()
+
+    return
+def write_fit_results(path,npar,niterations,seed=0):
+    '''
+        Fit results: best fit, one dataset and fast Monte-Carlo
+    '''
+
+    rng = numpy.random.RandomState(seed)
+    free  = ['ap','at','bias_LYA','beta_LYA'] + [ 'par_'+str(i) for i in range(max(0,npar-4)) ]
+    fixed = ['growth_rate']
+    strings = h5py.special_dtype(vlen=str)
+
+    f = h5py.File(path,'w')
+    best = f.create_group('best fit')
+    for p in free:
+        best.attrs[p] = sp.array([1.+0.1*rng.randn(),0.05])
+    for p in fixed:
+        best.attrs[p] = sp.array([0.97,0.])
+    best.attrs['fval'] = 1500.
+    best.attrs['ndata'] = 1590
+    best.attrs['npar'] = len(free)
+    best.attrs['zeff'] = 2.3
+    best.attrs.create('list of free pars',data=sp.array(free,dtype=object),dtype=strings)
+    best.attrs.create('list of fixed pars',data=sp.array(fixed,dtype=object),dtype=strings)
+
+    data = f.create_group('LYA(LYA)xLYA(LYA)')
+    data.attrs['chi2'] = 1500.
+    data.attrs['ndata'] = 1590
+    data.create_dataset('fit',data=rng.randn(2500))
+
+    mc = f.create_group('fast mc')
+    mc.attrs['niterations'] = niterations
+    mc.attrs['seed'] = seed
+    mc.attrs['covscaling'] = sp.ones(1)
+    mc.attrs.create('list of fiducial pars',data=sp.array(['ap'],dtype=object),dtype=strings)
+    mc.attrs.create('fiducial[ap]',data=sp.array(['1.','free'],dtype=object),dtype=strings)
+    mc.create_dataset('chi2',data=1590.+sp.sqrt(2.*1590.)*rng.randn(niterations))
+    for p in free+fixed:
+        g = mc.create_group(p)
+        g.create_dataset('values',data=1.+0.05*rng.randn(niterations))
+        g.create_dataset('errors',data=0.05*(1.+0.1*rng.randn(niterations)))
+    f.close()
+
+    return
+def write_files(directory,sizes=None,seed=0):
+    '''
+        Write all the synthetic files in directory, return their paths
+    '''
+
+    if sizes is None:
+        sizes = copy.deepcopy(raw_dic_sizes)
+
+    paths = {
+        'do_cor'    : os.path.join(directory,'cf.fits'),
+        'export'    : os.path.join(directory,'cf-exp.fits'),
+        'do_cor_1d' : os.path.join(directory,'cf1d.fits'),
+        'fit'       : os.path.join(directory,'result.h5'),
+    }
+    write_do_cor(paths['do_cor'],sizes['n_healpix'],sizes['np'],sizes['nt'],seed)
+    write_export(paths['export'],sizes['np'],sizes['nt'],seed)
+    write_do_cor_1d(paths['do_cor_1d'],sizes['n1d'],seed)
+    write_fit_results(paths['fit'],sizes['npar'],sizes['niterations'],seed)
+
+    return paths
+
+### Timing and memory
+def measure(func,repeat=3):
+    '''
+        Best wall time over repeat calls of func, and peak of the memory
+        allocated during one more call, traced apart not to bias the time
+    '''
+
+    times = []
+    for i in range(repeat):
+        t0 = time.time()
+        func()
+        times += [time.time()-t0]
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return { 'time':min(times), 'times':times, 'peak_bytes':peak }
+def get_cases(paths):
+    '''
+        Name and function of each benchmarked load, reduction
+        and plot-data path
+    '''
+
+    from . import correlation_1D, correlation_3D, correlation_3D_angl, fit
+
+    dic_3d = { 'correlation':'f_f', 'f1':'LYA', 'f2':'LYA', 'o1':None, 'o2':None,
+        'l1':None, 'l2':None, 'title':'', 'nside':16, 'read':'read_from_do_cor', 'path':paths['do_cor'] }
+    dic_exp = dict(dic_3d, read='read_from_export', path=paths['export'])
+    dic_angl = dict(dic_3d)
+    dic_angl.pop('read')
+    dic_1d = { 'correlation':'f_f', 'f1':'LYA', 'f2':'LYA', 'lmin1':None, 'lmin2':None,
+        'title':'', 'path':paths['do_cor_1d'] }
+    dic_fit = { 'title':'', 'path':paths['fit'] }
+
+    cor = correlation_3D.Correlation3D(dic_3d)
+    exp = correlation_3D.Correlation3D(dic_exp)
+    exp._co
+    compact = correlation_3D.Correlation3D(dict(dic_exp,compact_covariance=(5,5)))
+    compact._co
+    models = exp._da+1.e-4*numpy.random.RandomState(0).randn(100,exp._da.size)
+
+    def load_fit():
+        f = fit.Fit(dic_fit)
+        f.fastmc['ap']['values']
+        fit.close_files()
+
+    cases = [
+        ('Correlation3D.read_from_do_cor', lambda: correlation_3D.Correlation3D(dic_3d)),
+        ('Correlation3D.read_from_do_cor[block_size=16]', lambda: correlation_3D.Correlation3D(dict(dic_3d,block_size=16))),
+        ('Correlation3D.read_from_export', lambda: correlation_3D.Correlation3D(dic_exp)),
+        ('Correlation3D.read_from_export[_co]', lambda: correlation_3D.Correlation3D(dic_exp)._co),
+        ('Correlation3D.read_from_export[_er]', lambda: correlation_3D.Correlation3D(dic_exp)._er),
+        ('correlation_3D.stack', lambda: correlation_3D.stack([paths['do_cor']]*4,dic_3d)),
+        ('correlation_3D.ensemble[10 realizations]', lambda: correlation_3D.ensemble([paths['export']]*10,dic_exp)),
+        ('Correlation3D.compute_covariance', lambda: cor.compute_covariance()),
+        ('Correlation3D.compute_isotropic', lambda: cor.compute_isotropic()),
+        ('Correlation3D.compute_wedges', lambda: exp.compute_wedges([0.,0.5,0.8,0.95,1.])),
+        ('Correlation3D.compute_multipoles', lambda: exp.compute_multipoles()),
+        ('Correlation3D.chi2[100 models]', lambda: exp.chi2(models)),
+        ('Correlation3D.read_from_export[compact _co]', lambda: correlation_3D.Correlation3D(dict(dic_exp,compact_covariance=(5,5)))._co),
+        ('Correlation3D.chi2[100 models, compact _co]', lambda: compact.chi2(models)),
+        ('Correlation3D.distort[100 models]', lambda: exp.distort(models)),
+        ('utils.getCorrelationMatrix', lambda: utils.getCorrelationMatrix(exp._co)),
+        ('utils.getCorrelationMatrix[inplace,block_size=256]', lambda: utils.getCorrelationMatrix(sp.array(exp._co),inplace=True,block_size=256)),
+        ('utils.getCorrelationMatrix[inplace]', lambda: utils.getCorrelationMatrix(sp.array(exp._co),inplace=True)),
+        ('Correlation3D_angl.read_from_do_cor', lambda: correlation_3D_angl.Correlation3D_angl(dic_angl)),
+        ('Correlation1D.read_from_do_cor', lambda: correlation_1D.Correlation1D(dic_1d)),
+        ('Correlation1D.read_from_do_cor[block_size=128]', lambda: correlation_1D.Correlation1D(dict(dic_1d,block_size=128))),
+        ('Fit.read_fit_results', load_fit),
+        ('Fit.get_fastMC_stats', lambda: fit.Fit(dic_fit).get_fastMC_stats()),
+    ]
+
+    return cases
+def run(sizes=None,repeat=3,directory=None,only=None,seed=0):
+    '''
+        Write the synthetic files and measure each case.
+        only: list of substrings, to only run the matching cases
+    '''
+
+    if sizes is None:
+        sizes = copy.deepcopy(raw_dic_sizes)
+
+    tmp = None
+    if directory is None:
+        tmp = tempfile.mkdtemp(prefix='plot_picca_benchmark_')
+        directory = tmp
+
+    t0 = time.time()
+    paths = write_files(directory,sizes,seed)
+    print(' files written in {:.1f} s'.format(time.time()-t0))
+
+    results = []
+    for name, func in get_cases(paths):
+        if only is not None and not any( o in name for o in only ):
+            continue
+        res = measure(func,repeat)
+        res['name'] = name
+        results += [res]
+        print(' {:<50} {:10.4f} s {:10.1f} MiB'.format(name,res['time'],res['peak_bytes']/1024.**2))
+
+    if tmp is not None:
+        shutil.rmtree(tmp,ignore_errors=True)
+
+    return results
+def get_commit():
+
+    try:
+        out = subprocess.check_output(['git','rev-parse','HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),stderr=subprocess.STDOUT)
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+    return out.decode('utf-8').strip()
+def main():
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Time and memory benchmark of plot_picca on synthetic picca files')
+    for k, v in raw_dic_sizes.items():
+        parser.add_argument('--'+k.replace('_','-'),type=int,default=v,required=False,help='Size of the synthetic files')
+    parser.add_argument('--repeat',type=int,default=3,required=False,help='Number of timed calls of each case')
+    parser.add_argument('--seed',type=int,default=0,required=False,help='Seed of the synthetic files')
+    parser.add_argument('--directory',type=str,default=None,required=False,help='Directory of the synthetic files, temporary if None')
+    parser.add_argument('--only',type=str,nargs='*',default=None,required=False,help='Only run the cases matching one of these')
+    parser.add_argument('--no-import-time',action='store_true',required=False,help='Do not measure the import time')
+    parser.add_argument('--out',type=str,default=None,required=False,help='Output JSON file')
+    args = parser.parse_args()
+
+    sizes = { k:getattr(args,k) for k in raw_dic_sizes }
+
+    output = {
+        'commit'   : get_commit(),
+        'date'     : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python'   : platform.python_version(),
+        'platform' : platform.platform(),
+        'sizes'    : sizes,
+        'repeat'   : args.repeat,
+    }
+    if not args.no_import_time:
+        output['import_time'] = run_import_time()
+    output['results'] = run(sizes,args.repeat,args.directory,args.only,args.seed)
+
+    if args.out is not None:
+        with open(args.out,'w') as f:
+            json.dump(output,f,indent=1)
+    else:
+        print(json.dumps(output,indent=1))
+
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+### Python lib
+import os
+import json
+import time
+import shutil
+import hashlib
+import scipy as sp
+
+### Default directory and maximum size of the cache
+default_directory = os.path.join(os.path.expanduser('~'),'.cache','plot_picca')
+default_max_bytes = 10*1024**3
+
+def file_identity(path,sample_size=1024**2):
+    '''
+        Identity of a file: absolute path, size, modification time
+        and hash of the first, middle and last sample_size bytes
+    '''
+
+    path = os.path.abspath(os.path.expandvars(path))
+    stat = os.stat(path)
+
+    h = hashlib.sha1()
+    starts = set([0, max(0,stat.st_size//2-sample_size//2), max(0,stat.st_size-sample_size)])
+    with open(path,'rb') as f:
+        for start in sorted(starts):
+            f.seek(start)
+            h.update(f.read(sample_size))
+
+    identity = {
+        'path'  : path,
+        'size'  : stat.st_size,
+        'mtime' : stat.st_mtime,
+        'hash'  : h.hexdigest(),
+    }
+
+    return identity
+def get_cache(option):
+    '''
+        Cache from the 'cache' entry of a dictionary:
+        None or False for no cache, True for the default directory,
+        or the path to the directory
+    '''
+
+    if option is None or option is False:
+        return None
+    if option is True:
+        return Cache()
+
+    return Cache(directory=option)
+
+class Cache:
+    '''
+        On-disk cache of reduced arrays.
+        Each entry is a directory holding one .npy file per array and
+        a meta.json file. Entries are memory-mapped when loaded, and the
+        least recently used ones are removed when the cache is larger
+        than max_bytes.
+        The directory and maximum size default to the environment variables
+        PLOT_PICCA_CACHE_DIR and PLOT_PICCA_CACHE_MAX_BYTES.
+    '''
+
+    def __init__(self,directory=None,max_bytes=None):
+
+        if directory is None:
+            directory = os.environ.get('PLOT_PICCA_CACHE_DIR',default_directory)
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('PLOT_PICCA_CACHE_MAX_BYTES',default_max_bytes))
+
+        self._directory = os.path.expandvars(directory)
+        self._max_bytes = max_bytes
+
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+
+        return
+
+    def key(self,path,tag):
+        '''
+            Key of the entry for the file at path, read with the
+            reader described by tag (any JSON serializable object)
+        '''
+
+        identity = file_identity(path)
+        s = json.dumps([identity,tag],sort_keys=True)
+
+        return hashlib.sha1(s.encode('utf-8')).hexdigest()
+    def load(self,key):
+        '''
+            Return the attributes and the memory-mapped arrays of the entry,
+            or None if the entry is not in the cache
+        '''
+
+        entry = os.path.join(self._directory,key)
+        try:
+            with open(os.path.join(entry,'meta.json')) as f:
+                meta = json.load(f)
+            arrays = { a:sp.load(os.path.join(entry,a+'.npy'),mmap_mode='c') for a in meta['arrays'] }
+            os.utime(entry,None)
+        except (IOError,OSError,ValueError):
+            return None
+
+        return meta['attrs'], arrays
+    def store(self,key,attrs,arrays):
+        '''
+            Store the attributes (JSON serializable) and the arrays of the entry
+        '''
+
+        entry = os.path.join(self._directory,key)
+        tmp = entry+'.tmp'+str(os.getpid())
+
+        try:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+            os.makedirs(tmp)
+            for a, v in arrays.items():
+                sp.save(os.path.join(tmp,a+'.npy'),v)
+            meta = {'attrs':attrs, 'arrays':sorted(arrays.keys()), 'time':time.time()}
+            with open(os.path.join(tmp,'meta.json'),'w') as f:
+                json.dump(meta,f)
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            os.rename(tmp,entry)
+        except (IOError,OSError):
+            shutil.rmtree(tmp,ignore_errors=True)
+            return
+
+        self.evict()
+
+        return
+    def size(self):
+        '''
+            Size of each entry in bytes, with its last access time
+        '''
+
+        entries = {}
+        for key in os.listdir(self._directory):
+            entry = os.path.join(self._directory,key)
+            if not os.path.isdir(entry) or '.tmp' in key:
+                continue
+            nbytes = sum( os.path.getsize(os.path.join(entry,f)) for f in os.listdir(entry) )
+            entries[key] = (os.path.getmtime(entry),nbytes)
+
+        return entries
+    def evict(self):
+        '''
+            Remove the least recently used entries until the cache
+            is smaller than max_bytes
+        '''
+
+        entries = self.size()
+        total = sum( v[1] for v in entries.values() )
+        for key in sorted(entries, key=lambda k: entries[k][0]):
+            if total<=self._max_bytes:
+                break
+            shutil.rmtree(os.path.join(self._directory,key),ignore_errors=True)
+            total -= entries[key][1]
+
+        return
+    def clear(self):
+
+        shutil.rmtree(self._directory,ignore_errors=True)
+        os.makedirs(self._directory)
+
+        return
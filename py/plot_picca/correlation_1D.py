@@ -1,11 +1,15 @@
 ### Python lib
-import fitsio
 import scipy as sp
 import copy
-import matplotlib.pyplot as plt
+import functools
 
 from . import utils
 from . import constants
+from . import cache
+from . import matrix
+from . import profiling
+
+fitsio = utils.LazyModule('fitsio')
 
 raw_dic_class = {
     "correlation"             : None,
@@ -15,10 +19,15 @@ raw_dic_class = {
     "lmin2"                   : None,
     "path"                    : None,
     "title"                   : None,
+    "cache"                   : None,
+    "block_size"              : None,
 }
 
 class Correlation1D:
 
+    ### Read from the file on first access, see read_from_do_cor
+    _mat = utils.lazy_attribute('_mat')
+
     def __init__(self,dic=None):
 
         if (dic is None):
@@ -31,6 +40,16 @@ class Correlation1D:
         self._lmin1 = dic["lmin1"]
         self._lmin2 = dic["lmin2"]
         self._title = dic["title"]
+        if "cache" not in dic.keys():
+            dic["cache"] = None
+        self._cache = cache.get_cache(dic["cache"])
+        if "block_size" not in dic.keys():
+            dic["block_size"] = None
+        self._block_size = dic["block_size"]
+
+        ### Loaders of the lazy attributes
+        self._path    = None
+        self._loaders = {}
 
         ### List obsorber
         self._listAbs1 = None
@@ -58,61 +77,160 @@ class Correlation1D:
 
         return
 
-    def read_from_do_cor(self,path):
+    def set_grid(self,head):
 
-        vac = fitsio.FITS(path)
-        head  = vac[1].read_header()
         self._llmin = head['LLMIN']
         self._llmax = head['LLMAX']
         self._dll   = head['DLL']
         self._n1d   = int((self._llmax-self._llmin)/self._dll+1)
 
-        ### All Matrix
-        self._mat = {}
-        self._mat["DA"] = vac[2]['DA'][:]
-        self._mat["WE"] = vac[2]['WE'][:]
-        self._mat["NB"] = vac[2]['NB'][:]
+        return
+    @profiling.staged('read columns')
+    def read_mat(self,path):
+        '''
+            Read the DA, WE and NB matrices, packed to the filled triangle
+            and to the diagonals with pairs
+        '''
+
+        vac = fitsio.FITS(path)
+
+        ### Layout from the number of pairs in each diagonal
+        nb = vac[2]['NB'][:]
+        n  = nb.shape[0]
+        sum_nb = utils.sum_diagonals(nb)
+        lower = (sum_nb[n-1:]>0.).sum()==0
+        if lower:
+            nonzero = (sum_nb[:n][::-1]>0.)
+        else:
+            nonzero = (sum_nb[n-1:]>0.)
+        nband = 1
+        if nonzero.any():
+            nband = sp.arange(n)[nonzero].max()+1
+
+        mat = {}
+        mat["NB"] = matrix.pack(nb,nband,lower)
+        del nb
+        mat["DA"] = matrix.pack(vac[2]['DA'][:],nband,lower)
+        mat["WE"] = matrix.pack(vac[2]['WE'][:],nband,lower)
+
+        vac.close()
+
+        return mat
+    @profiling.staged('reduce')
+    def read_sums(self,path):
+        '''
+            Read the DA, WE and NB matrices block_size rows at a time,
+            and keep only their diagonal and their sums over each diagonal
+            of the filled triangle
+        '''
+
+        n = self._n1d
+        diag = { k:sp.zeros(n) for k in ['DA','WE','NB'] }
+        sums = { k:sp.zeros(2*n-1) for k in ['WDA','WE','NB'] }
+
+        vac = fitsio.FITS(path)
+        for start, block in utils.iter_rows(vac[2],['DA','WE','NB'],self._block_size):
+            i = sp.arange(block['DA'].shape[0])
+            for k in diag:
+                diag[k][start+i] = block[k][i,start+i]
+            sums['WDA'] += utils.sum_diagonals(block['DA'],mat2=block['WE'],row_start=start)
+            sums['WE']  += utils.sum_diagonals(block['WE'],row_start=start)
+            sums['NB']  += utils.sum_diagonals(block['NB'],row_start=start)
+        vac.close()
+
+        ### Diagonals k=0..n1d-1, or k=0..1-n1d if only the lower triangle is filled
+        inDown = (sums['NB'][n-1:]>0.).sum()==0
+        for k in sums:
+            if inDown:
+                sums[k] = sums[k][:n][::-1]
+            else:
+                sums[k] = sums[k][n-1:]
+
+        return diag, sums, inDown
+    def set_var_cor(self,diag,sums,inDown):
+        '''
+            Set the variance from the diagonals of DA, WE and NB,
+            and the correlation from the sums of DA*WE, WE and NB
+            over the diagonals of the filled triangle, from the main one outward
+        '''
 
         ### Variance
         self._var = sp.zeros( (self._n1d,4) )
         self._var[:,0] = 10.**( sp.arange(self._n1d)*self._dll+self._llmin )
-        self._var[:,1] = sp.diag(self._mat["DA"])
-        self._var[:,2] = sp.diag(self._mat["WE"])
-        self._var[:,3] = sp.diag(self._mat["NB"])
+        self._var[:,1] = diag["DA"]
+        self._var[:,2] = diag["WE"]
+        self._var[:,3] = diag["NB"]
 
         ### Correlation
         self._cor = sp.zeros( (self._n1d,4) )
         self._cor[:,0] = 10.**( sp.arange(self._n1d)*self._dll )
 
-        inDown = False
-        upperTri = sp.triu(self._mat["NB"])
-        if (upperTri>0.).sum()==0:
-            inDown=True
+        idx = sp.arange(sums['NB'].size)
+        if inDown:
             self._cor[:,0] = self._cor[:,0][::-1]
+            idx = self._n1d-1-idx
 
         norm=1.
-        if sp.trace(self._mat["NB"])>0:
-            norm = sp.sum(sp.diag(self._mat["DA"],k=0)*sp.diag(self._mat["WE"],k=0))/sp.trace(self._mat["WE"],offset=0)
+        if sums['NB'][0]>0:
+            norm = sums['WDA'][0]/sums['WE'][0]
 
-        for i in range(self._n1d):
-            d = i
-            if inDown:
-                d = 1+i-self._n1d
-            tda = sp.diag(self._mat["DA"],k=d)
-            twe = sp.diag(self._mat["WE"],k=d)
-            tnb = sp.trace(self._mat["NB"],offset=d)
-            if tnb>0:
-                self._cor[i,1] = sp.sum(tda*twe)/sp.sum(twe)/norm
-                self._cor[i,2] = sp.sum(twe)/norm
-                self._cor[i,3] = tnb
+        w = (sums['NB']>0)
+        self._cor[idx[w],1] = sums['WDA'][w]/sums['WE'][w]/norm
+        self._cor[idx[w],2] = sums['WE'][w]/norm
+        self._cor[idx[w],3] = sums['NB'][w]
 
-        vac.close()
+        return
+    def read_from_do_cor(self,path):
+
+        self._path = path
+
+        ### Reduced arrays from the cache, the matrices are read if needed
+        if self._cache is not None:
+            key = self._cache.key(path,['Correlation1D.read_from_do_cor'])
+            cached = self._cache.load(key)
+            if cached is not None:
+                head, arrays = cached
+                self.set_grid(head)
+                self._var = arrays['VAR']
+                self._cor = arrays['COR']
+                self._loaders['_mat'] = functools.partial(self.read_mat,path)
+                return
+
+        with profiling.stage('open',path=path):
+            vac = fitsio.FITS(path)
+            head  = vac[1].read_header()
+            vac.close()
+        self.set_grid(head)
+
+        if self._block_size is None:
+            ### All Matrix
+            self._mat = self.read_mat(path)
+            diag = { k:self._mat[k].diagonal(0) for k in ['DA','WE','NB'] }
+            sums = {
+                'WDA' : self._mat["DA"].multiply(self._mat["WE"]).diagonal_sums(),
+                'WE'  : self._mat["WE"].diagonal_sums(),
+                'NB'  : self._mat["NB"].diagonal_sums(),
+            }
+            inDown = self._mat["NB"].lower
+        else:
+            ### Matrix read by blocks of rows, and only kept if plot_mat is called
+            diag, sums, inDown = self.read_sums(path)
+            self._loaders['_mat'] = functools.partial(self.read_mat,path)
+
+        self.set_var_cor(diag,sums,inDown)
+
+        if self._cache is not None:
+            head = { 'LLMIN':float(head['LLMIN']), 'LLMAX':float(head['LLMAX']), 'DLL':float(head['DLL']) }
+            self._cache.store(key,head,{ 'VAR':self._var, 'COR':self._cor })
 
         return
-    def plot_var(self,other=None,redshiftLine=None):
+    def plot_var(self,other=None,redshiftLine=None,ax=None):
 
+        ax, show = utils.get_axes(ax)
+
+        lst_corr = [self]
         if not other is None:
-            lst_corr = [self] + other
+            lst_corr += other
 
         for c in lst_corr:
             x = c._var[:,0]
@@ -124,24 +242,26 @@ class Correlation1D:
             if not redshiftLine is None:
                 x = x/redshiftLine-1.
             if c._title is not None:
-                plt.plot(x,y,linewidth=4,label=r"$"+c._title+"$")
-            else:plt.plot(x,y,linewidth=4)
+                ax.plot(x,y,linewidth=4,label=r"$"+c._title+"$")
+            else:ax.plot(x,y,linewidth=4)
 
 
         if not redshiftLine is None:
-            plt.xlabel(r'$z$',fontsize=30)
+            ax.set_xlabel(r'$z$',fontsize=30)
         else:
-            plt.xlabel(r'$\lambda_{\mathrm{Obs.}} \, [\mathrm{\AA{}}]$',fontsize=30)
-        plt.ylabel(r'$\sigma^{2}(\lambda_{\mathrm{Obs.}})$',fontsize=30)
-        plt.legend(fontsize=20, numpoints=1,ncol=2, loc=1)
-        plt.grid()
-        plt.show()
+            ax.set_xlabel(r'$\lambda_{\mathrm{Obs.}} \, [\mathrm{\AA{}}]$',fontsize=30)
+        ax.set_ylabel(r'$\sigma^{2}(\lambda_{\mathrm{Obs.}})$',fontsize=30)
+        ax.legend(fontsize=20, numpoints=1,ncol=2, loc=1)
+        ax.grid()
 
-        return
-    def plot_cor(self,other=None,lines=False,lineToShow=None,redshiftLine=None):
+        return utils.show_axes(ax,show)
+    def plot_cor(self,other=None,lines=False,lineToShow=None,redshiftLine=None,ax=None):
 
+        ax, show = utils.get_axes(ax)
+
+        lst_corr = [self]
         if not other is None:
-            lst_corr = [self] + other
+            lst_corr += other
 
         ###
         minY = None
@@ -156,9 +276,9 @@ class Correlation1D:
             if not redshiftLine is None:
                 x = utils.dist_lines_Obs(lObs1=redshiftLine[0],lObs2=redshiftLine[0]/x,lRF=redshiftLine[1])
             if c._title is not None:
-                plt.plot(x,y,linewidth=4,label=r"$"+c._title+"$",marker='o')
+                ax.plot(x,y,linewidth=4,label=r"$"+c._title+"$",marker='o')
             else:
-                plt.plot(x,y,linewidth=4,marker='o')
+                ax.plot(x,y,linewidth=4,marker='o')
 
             if minY is None:
                 minY = y.min()
@@ -201,51 +321,59 @@ class Correlation1D:
                         lst_lines += [a1+"__"+a2]
                         if not redshiftLine is None:
                             q = utils.dist_lines_Obs(lObs1=redshiftLine[0],lObs2=redshiftLine[0]/q,lRF=redshiftLine[1])
-                        plt.plot( [q,q], [minY,maxY], color="black")
+                        ax.plot( [q,q], [minY,maxY], color="black")
                         if l1<l2: name = a1+"\,/\,"+a2
                         else: name = a2+"\,/\,"+a1
-                        plt.text( q, 0.95*maxY, s=r"$\mathrm{"+name+"}$", rotation='vertical', fontsize=15)
+                        ax.text( q, 0.95*maxY, s=r"$\mathrm{"+name+"}$", rotation='vertical', fontsize=15)
 
         if not redshiftLine is None:
-            plt.xlabel(r'$\Delta r_{\parallel} \, [\mathrm{Mpc \, h^{-1}}]$',fontsize=30)
+            ax.set_xlabel(r'$\Delta r_{\parallel} \, [\mathrm{Mpc \, h^{-1}}]$',fontsize=30)
         else:
-            plt.xlabel(r'$\lambda_{1}/\lambda_{2}$',fontsize=30)
-        plt.ylabel(r'$\xi^{1D}(\lambda_{1}/\lambda_{2})/\sqrt{\xi^{1D}(\lambda_{1})\xi^{1D}(\lambda_{2})}$',fontsize=30)
-        plt.legend(fontsize=20, numpoints=1,ncol=2, loc=1)
-        plt.grid()
+            ax.set_xlabel(r'$\lambda_{1}/\lambda_{2}$',fontsize=30)
+        ax.set_ylabel(r'$\xi^{1D}(\lambda_{1}/\lambda_{2})/\sqrt{\xi^{1D}(\lambda_{1})\xi^{1D}(\lambda_{2})}$',fontsize=30)
+        ax.legend(fontsize=20, numpoints=1,ncol=2, loc=1)
+        ax.grid()
         #plt.tight_layout()
         #plt.savefig("fig.png")
         #plt.clf()
-        plt.show()
 
-        return
-    def plot_mat(self):
+        return utils.show_axes(ax,show)
+    def plot_mat(self,axs=None):
+        '''
+            Plot the correlation matrix, and its first diagonals.
+            axs: list of the two axes to draw into, or None for two new figures.
+            Return the two figures
+        '''
+
+        if axs is None:
+            axs = [None,None]
+        figs = []
 
         ###
-        da = sp.copy(self._mat["DA"])
+        ax, show = utils.get_axes(axs[0])
+        da = self._mat["DA"].dense()
         if sp.trace(da)!=0.:
-            da = utils.getCorrelationMatrix(da)
-        w = (self._mat["WE"]>0.) & (self._mat["NB"]>10)
+            da = utils.getCorrelationMatrix(da,inplace=True)
+        w = (self._mat["WE"].dense()>0.) & (self._mat["NB"].dense()>10)
         da[ sp.logical_not(w) ] = sp.nan
 
-        fig = plt.figure()
-        ax = fig.add_subplot(111)
-        plt.imshow(da,origin="lower",interpolation='nearest')
-        cbar = plt.colorbar()
-        plt.grid(True)
+        im = ax.imshow(da,origin="lower",interpolation='nearest')
+        cbar = ax.figure.colorbar(im,ax=ax)
+        ax.grid(True)
         cbar.formatter.set_powerlimits((0, 0))
         cbar.update_ticks()
-        plt.show()
+        figs += [utils.show_axes(ax,show)]
 
         ###
+        ax, show = utils.get_axes(axs[1])
         for k in range(5):
-            x = sp.arange(sp.diag(self._mat["DA"],k=k).size)
-            y = sp.diag(self._mat["DA"],k=k)
-            w = (sp.diag(self._mat["WE"],k=k)>0.) & (sp.diag(self._mat["NB"],k=k)>10.)
+            x = sp.arange(self._mat["DA"].diagonal(k).size)
+            y = self._mat["DA"].diagonal(k)
+            w = (self._mat["WE"].diagonal(k)>0.) & (self._mat["NB"].diagonal(k)>10.)
             x = x[w]
             y = y[w]
-            plt.plot(x,y,linewidth=4,alpha=0.7)
-        plt.grid()
-        plt.show()
+            ax.plot(x,y,linewidth=4,alpha=0.7)
+        ax.grid()
+        figs += [utils.show_axes(ax,show)]
 
-        return
+        return figs
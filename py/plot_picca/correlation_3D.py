@@ -1,11 +1,16 @@
 ### Python lib
-import fitsio
+import sys
+import numpy
 import scipy as sp
+import scipy.sparse
+import scipy.linalg
 import copy
-import matplotlib.pyplot as plt
+import functools
+import multiprocessing
 
-from . import utils, constants
-from picca import wedgize
+from . import utils, constants, cache, projection, profiling, matrix
+
+fitsio = utils.LazyModule('fitsio')
 
 raw_dic_class = {
     "correlation"             : "",
@@ -18,11 +23,20 @@ raw_dic_class = {
     "path"                    : None,
     "title"                   : "",
     "nside"                   : None,
+    "block_size"              : None,
+    "sidecar"                 : False,
+    "cache"                   : None,
+    "compact_covariance"      : None,
     'read'                    : 'read_from_do_cor',
 }
 
 class Correlation3D:
 
+    ### Read from the file on first access, see read_from_export
+    _co = utils.lazy_attribute('_co')
+    _dm = utils.lazy_attribute('_dm')
+    _er = utils.lazy_attribute('_er')
+
     def __init__(self,dic=None):
 
         if (dic is None):
@@ -48,6 +62,31 @@ class Correlation3D:
         if "nside" not in dic.keys():
             dic["nside"] = 16
         self._nside = dic["nside"]
+        if "block_size" not in dic.keys():
+            dic["block_size"] = None
+        self._block_size = dic["block_size"]
+        if "sidecar" not in dic.keys():
+            dic["sidecar"] = False
+        self._sidecar = dic["sidecar"]
+        if "cache" not in dic.keys():
+            dic["cache"] = None
+        self._cache = cache.get_cache(dic["cache"])
+        if "compact_covariance" not in dic.keys():
+            dic["compact_covariance"] = None
+        self._compact_covariance = dic["compact_covariance"]
+
+        ### Loaders of the lazy attributes
+        self._path    = None
+        self._loaders = {}
+
+        ### Cache of the isotropic bin indices, for each bin size
+        self._isotropic_index = {}
+
+        ### Cache of the Cholesky factor of the covariance
+        self._cholesky = None
+
+        ### Cache of the distortion matrix, sparse if possible
+        self._distortion = None
 
         ### bin size (only square)
         self._binSize = None
@@ -103,12 +142,9 @@ class Correlation3D:
 
         return
 
-    def read_from_do_cor(self,path):
-
-        vac = fitsio.FITS(path)
+    def set_grid(self,head):
 
         ### bin size (only square)
-        head = vac[1].read_header()
         self._binSize = head['RTMAX'] / head['NT']
 
         ### Grid
@@ -125,62 +161,142 @@ class Correlation3D:
         else:
             print("binSizeP!=binSizeT")
 
-        self._rp = vac[1]['RP'][:]
-        self._rt = vac[1]['RT'][:]
+        return
+    def read_from_do_cor(self,path):
+
+        self._path = path
+        read_da = self._correlation not in ['o_o','o1_o2']
+
+        ### Reduced arrays from the cache
+        if self._cache is not None:
+            key = self._cache.key(path,['Correlation3D.read_from_do_cor',read_da])
+            cached = self._cache.load(key)
+            if cached is not None:
+                head, arrays = cached
+                self.set_grid(head)
+                self._rp = arrays['RP']
+                self._rt = arrays['RT']
+                self._r  = sp.sqrt(self._rp**2. + self._rt**2.)
+                self._z  = arrays['Z']
+                self._nb = arrays['NB']
+                self._we = arrays['WE']
+                if read_da:
+                    self._da = arrays['DA']
+                return
+
+        with profiling.stage('open',path=path):
+            vac = fitsio.FITS(path)
+            head = vac[1].read_header()
+        self.set_grid(head)
+
+        with profiling.stage('read columns',path=path):
+            self._rp = vac[1]['RP'][:]
+            self._rt = vac[1]['RT'][:]
+            self._z  = vac[1]['Z'][:]
+            self._nb = vac[1]['NB'][:]
         self._r = sp.sqrt(self._rp**2. + self._rt**2.)
-        self._z  = vac[1]['Z'][:]
-        self._nb = vac[1]['NB'][:]
 
         ### Correlation
-        we  = vac[2]['WE'][:]
-        self._we = we.sum(axis=0)
-        if self._correlation not in ['o_o','o1_o2']:
-            da  = vac[2]['DA'][:]
+        self._we, wda = utils.reduce_healpix(vac[2],read_da=read_da,block_size=self._block_size)
+        if read_da:
             cut = (self._we>0.)
-            self._da       = (da*we).sum(axis=0)
+            self._da       = wda
             self._da[cut] /= self._we[cut]
 
         vac.close()
 
+        if self._cache is not None:
+            head = utils.get_grid_header(head)
+            arrays = { 'RP':self._rp, 'RT':self._rt, 'Z':self._z, 'NB':self._nb, 'WE':self._we }
+            if read_da:
+                arrays['DA'] = self._da
+            self._cache.store(key,head,arrays)
+
         return
     def read_from_export(self,path):
 
-        vac = fitsio.FITS(path)
-
-        ### bin size (only square)
-        head = vac[1].read_header()
-        self._binSize = head['RTMAX'] / head['NT']
+        self._path = path
+        with profiling.stage('open',path=path):
+            vac = fitsio.FITS(path)
+            head = vac[1].read_header()
+        self.set_grid(head)
+
+        with profiling.stage('read columns',path=path):
+            self._rp = vac[1]['RP'][:]
+            self._rt = vac[1]['RT'][:]
+            self._z  = vac[1]['Z'][:]
+            self._da = vac[1]['DA'][:]
+            self._nb = vac[1]['NB'][:]
+        self._r  = sp.sqrt(self._rp**2. + self._rt**2.)
 
-        ### Grid
-        self._nt = head['NT']
-        self._np = head['NP']
-        self._rt_min = 0.
-        self._rt_max = head['RTMAX']
-        self._rp_min = head['RPMIN']
-        self._rp_max = head['RPMAX']
-        self._binSizeP = (self._rp_max-self._rp_min) / self._np
-        self._binSizeT = (self._rt_max-self._rt_min) / self._nt
-        if self._binSizeP==self._binSizeT:
-            self._binSize = self._binSizeP
+        ### Covariance and distortion matrix are only read when needed
+        if self._compact_covariance is None:
+            self._loaders['_co'] = functools.partial(utils.read_column,path,'CO',sidecar=self._sidecar)
         else:
-            print("binSizeP!=binSizeT")
+            max_dp, max_dt = self._compact_covariance
+            self._loaders['_co'] = functools.partial(utils.read_offset_covariance,path,'CO',self._np,self._nt,max_dp,max_dt)
+        self._loaders['_dm'] = functools.partial(utils.read_column,path,'DM',sidecar=self._sidecar)
+        self._loaders['_er'] = self.get_errors_from_covariance
+
+        vac.close()
 
-        self._rp = vac[1]['RP'][:]
-        self._rt = vac[1]['RT'][:]
+        return
+    def read_from_sums(self,sums):
+        '''
+            Set the correlation from raw weighted sums, see read_sums_from_do_cor
+        '''
+
+        self.set_grid(sums['head'])
+
+        self._we = sp.array(sums['WE'])
+        self._nb = sp.array(sums['NB'])
+        cut = (self._we>0.)
+
+        self._rp = sp.zeros(self._we.size)
+        self._rt = sp.zeros(self._we.size)
+        self._z  = sp.zeros(self._we.size)
+        self._rp[cut] = sums['WRP'][cut]/self._we[cut]
+        self._rt[cut] = sums['WRT'][cut]/self._we[cut]
+        self._z[cut]  = sums['WZ'][cut]/self._we[cut]
         self._r  = sp.sqrt(self._rp**2. + self._rt**2.)
-        self._z  = vac[1]['Z'][:]
-        self._da = vac[1]['DA'][:]
-        self._co = vac[1]['CO'][:]
-        self._dm = vac[1]['DM'][:]
-        self._nb = vac[1]['NB'][:]
 
-        self._er = sp.copy(sp.diag(self._co))
-        cut = (self._er>0.)
-        self._er[cut] = sp.sqrt(self._er[cut])
+        if sums['WDA'] is not None:
+            self._da = sp.zeros(self._we.size)
+            self._da[cut] = sums['WDA'][cut]/self._we[cut]
 
-        vac.close()
+        return
+    def read_from_moments(self,moments):
+        '''
+            Set the correlation from the moments of an ensemble of
+            realizations, see get_moments: the mean, and the covariance
+            of one realization
+        '''
+
+        self.set_grid(moments['head'])
+
+        self._rp = moments['RP']
+        self._rt = moments['RT']
+        self._r  = sp.sqrt(self._rp**2. + self._rt**2.)
+        self._z  = moments['Z']
+        self._nb = moments['NB']
+        self._da = moments['mean']
+
+        if moments['n']>1:
+            self._co = moments['M2']/(moments['n']-1.)
+            self._er = self.get_errors_from_covariance()
 
         return
+    def get_errors_from_covariance(self):
+
+        ### Avoid keeping the full covariance in memory if it was not read yet
+        if '_co' in self._loaders and not self._sidecar:
+            er = utils.read_column_diagonal(self._path,'CO')
+        else:
+            er = sp.array(self._co.diagonal())
+        cut = (er>0.)
+        er[cut] = sp.sqrt(er[cut])
+
+        return er
     def get_mean_redshift(self,rmin=80.,rmax=120.):
 
         cut = (self._r>rmin) & (self._r<rmax)
@@ -204,20 +320,392 @@ class Correlation3D:
         print("beta     = ",val)
 
         return
+    @profiling.staged('reduce')
+    def compute_covariance(self,method='subsample',nboot=1000,seed=None,block_size=256):
+        '''
+            Covariance of the correlation from the per-HEALPix rows
+            of the do_cor file, read block_size rows at a time:
+                - 'subsample': weighted covariance of the sub-samples, as in picca
+                - 'jackknife': delete-one jackknife over the pixels
+                - 'bootstrap': nboot resamplings of the pixels
+            Set _co and _er and return the covariance
+        '''
+
+        if method not in ['subsample','jackknife','bootstrap']:
+            print(method, ' is unknown')
+            sys.exit()
+
+        nbins = self._we.size
+        we_tot = self._we
+        xi  = sp.zeros(nbins)
+        cut = (we_tot>0.)
+        xi[cut] = self._da[cut]
+        wda_tot = xi*we_tot
+
+        vac = fitsio.FITS(self._path)
+        nrows = vac[2].get_nrows()
+
+        if method=='bootstrap':
+            rng = numpy.random.RandomState(seed)
+            counts = rng.multinomial(nrows,sp.ones(nrows)/nrows,size=nboot).astype(float)
+            sum_wda = sp.zeros((nboot,nbins))
+            sum_we  = sp.zeros((nboot,nbins))
+        else:
+            sum_d  = sp.zeros(nbins)
+            sum_dd = sp.zeros((nbins,nbins))
+            npix   = 0
+
+        for start, block in utils.iter_rows(vac[2],['WE','DA'],block_size):
+            we  = block['WE']
+            wda = block['DA']*we
+
+            if method=='subsample':
+                d = wda-we*xi
+            elif method=='jackknife':
+                w = (we.sum(axis=1)>0.)
+                we  = we[w]
+                wda = wda[w]
+                npix += w.sum()
+                sub_we = we_tot-we
+                w = (sub_we>0.)
+                sub_we[sp.logical_not(w)] = 1.
+                d = (wda_tot-wda)/sub_we - xi
+                d[sp.logical_not(w)] = 0.
+            else:
+                c = counts[:,start:start+we.shape[0]]
+                sum_wda += c.dot(wda)
+                sum_we  += c.dot(we)
+                continue
+
+            sum_d  += d.sum(axis=0)
+            sum_dd += d.T.dot(d)
+
+        vac.close()
+
+        if method=='subsample':
+            norm = sp.zeros(nbins)
+            norm[cut] = 1./we_tot[cut]
+            cov  = sum_dd
+            cov *= norm[:,None]
+            cov *= norm
+        elif method=='jackknife':
+            cov = (npix-1.)/npix*(sum_dd-sp.outer(sum_d,sum_d)/npix)
+        else:
+            xi_boot = sp.zeros((nboot,nbins))+xi
+            cut = (sum_we>0.)
+            xi_boot[cut] = sum_wda[cut]/sum_we[cut]
+            xi_boot -= xi_boot.mean(axis=0)
+            cov = xi_boot.T.dot(xi_boot)/(nboot-1.)
+
+        self._co = cov
+        self._er = self.get_errors_from_covariance()
+
+        return cov
+    def compress_covariance(self,max_dp=None,max_dt=None):
+        '''
+            Replace the covariance by its compact form keyed by the offset
+            (Delta rp, Delta rt), without the offsets larger than max_dp
+            and max_dt bins, see matrix.OffsetCovariance.
+            Read by blocks of rows from the file if not read yet
+        '''
+
+        if '_co' in self._loaders:
+            self._co = utils.read_offset_covariance(self._path,'CO',self._np,self._nt,max_dp,max_dt)
+        else:
+            self._co = matrix.compress([(0,self._co)],self._np,self._nt,max_dp,max_dt)
+
+        return self._co
     def covariance_is_valid(self):
 
         try:
-            sp.linalg.cholesky(self._co)
+            self.get_cholesky()
         except:
             return False
 
         return True
-    def plot_2d(self,x_power=0):
+    def get_cholesky(self):
+        '''
+            Lower triangular Cholesky factor L of the covariance, C = L.L^T,
+            or upper banded factor for a compact covariance.
+            Cached as long as _co is not replaced, so the covariance
+            should not be modified in place
+        '''
+
+        if self._cholesky is not None and self._cholesky[0] is self._co:
+            return self._cholesky[1]
+
+        co = self._co
+        if isinstance(co,matrix.OffsetCovariance):
+            chol = co.cholesky()
+        else:
+            chol = sp.linalg.cholesky(co,lower=True)
+        self._cholesky = (co,chol)
+
+        return chol
+    def chi2(self,model):
+        '''
+            Chi2 of the model against the correlation, with the covariance.
+            model is one vector (return a float) or an array n_models x n_bins
+            (return an array of size n_models).
+            The covariance is factorized once, see get_cholesky
+        '''
+
+        chol = self.get_cholesky()
+
+        model = sp.asarray(model)
+        res = (model-self._da).T
+        if isinstance(self._co,matrix.OffsetCovariance):
+            chi2 = (res*self._co.solve(res)).sum(axis=0)
+        else:
+            res = sp.linalg.solve_triangular(chol,res,lower=True,check_finite=False)
+            chi2 = (res**2).sum(axis=0)
+
+        return chi2
+    def get_distortion_matrix(self,density=0.1):
+        '''
+            Distortion matrix, in CSR format if less than a fraction density
+            of its elements are non-zero, dense otherwise.
+            If _dm was not read yet, it is read by blocks of rows from the file
+            and never held dense in memory.
+            Cached as long as _dm is not replaced.
+            Raise ValueError if there is no distortion matrix, e.g. read from do_cor
+        '''
+
+        if '_dm' in self._loaders:
+            if self._distortion is not None and self._distortion[0] is None:
+                return self._distortion[1]
+            mat = utils.read_column_sparse(self._path,'DM')
+            dm = None
+        else:
+            dm = self._dm
+            if dm is None:
+                raise ValueError('No distortion matrix: the correlation was not read from an export file with a DM column')
+            if self._distortion is not None and self._distortion[0] is dm:
+                return self._distortion[1]
+            mat = sp.sparse.csr_matrix(dm)
+
+        if mat.nnz>density*mat.shape[0]*mat.shape[1]:
+            mat = mat.toarray()
+        self._distortion = (dm,mat)
+
+        return mat
+    def distort(self,models):
+        '''
+            Apply the distortion matrix to the undistorted models,
+            one vector or an array n_models x n_bins, in one product
+        '''
+
+        dm = self.get_distortion_matrix()
+        models = sp.asarray(models)
+
+        return dm.dot(models.T).T
+    def get_isotropic_index(self,bin_size):
+        '''
+            Index of the isotropic bin of each (rp,rt) bin, -1 if in none.
+            A bin i holds i*bin_size < r < (i+1)*bin_size.
+            Cached for each bin size, as long as _r is not replaced
+        '''
+
+        if bin_size in self._isotropic_index and self._isotropic_index[bin_size][0] is self._r:
+            return self._isotropic_index[bin_size][1]
+
+        size = int(sp.amax(self._r)/bin_size)
+        idx = sp.floor(self._r/bin_size).astype(int)
+        idx[self._r<=idx*bin_size] -= 1
+        idx[self._r>=(idx+1)*bin_size] += 1
+        w = (self._r>idx*bin_size) & (self._r<(idx+1)*bin_size) & (idx>=0) & (idx<size)
+        idx[sp.logical_not(w)] = -1
+
+        self._isotropic_index[bin_size] = (self._r,idx)
+
+        return idx
+    def compute_isotropic(self,bin_size=None,x_power=0):
+        '''
+            Isotropic correlation, averaged with the weights in bins of r.
+            Return r, r**x_power * xi and the weights,
+            for r < min(rp_max,rt_max)
+        '''
+
+        if bin_size is None:
+            bin_size = self._binSize
+
+        idx  = self.get_isotropic_index(bin_size)
+        size = int(sp.amax(self._r)/bin_size)
+        w    = (idx>=0)
+
+        wee = sp.bincount(idx[w],weights=self._we[w],minlength=size)
+        xxx = sp.bincount(idx[w],weights=(self._we*self._r)[w],minlength=size)
+        yyy = sp.bincount(idx[w],weights=(self._we*self._da)[w],minlength=size)
+
+        cut = wee>0.
+        xxx[cut] /= wee[cut]
+        yyy[cut] /= wee[cut]
+        cut = xxx<min(self._rp_max,self._rt_max)
+        xxx = xxx[cut]
+        yyy = yyy[cut]
+        wee = wee[cut]
+
+        coef = sp.power(xxx,x_power)
+
+        return xxx, coef*yyy, wee
+    @profiling.staged('project')
+    def compute_multipoles(self,ells=(0,2,4),rmin=0.,rmax=None,nr=None,ss=10,da=None,covariance=True):
+        '''
+            Legendre multipoles of the correlation, or of the models in da
+            (one vector or an array n_models x n_bins).
+            The projection matrix P is built once for each geometry.
+            Return r, the multipoles (... x len(ells) x nr) and,
+            if covariance, P.C.P^T
+        '''
+
+        if rmax is None:
+            rmax = self._rt_max
+        if nr is None:
+            nr = self._nt
+
+        mat = projection.get_multipole_matrix(self._rp_min,self._rp_max,self._np,
+            self._rt_min,self._rt_max,self._nt,rmin,rmax,nr,ells,ss)
+
+        if da is None:
+            da = self._da
+        da = sp.asarray(da)
+        xi = mat.dot(da.T).T
+        xi = xi.reshape(da.shape[:-1]+(len(ells),nr))
+
+        co = None
+        if covariance and self._co is not None:
+            co = self._co
+            if isinstance(co,matrix.OffsetCovariance):
+                co = co.tocsr()
+            co = mat.dot(mat.dot(co).T)
+            if sp.sparse.issparse(co):
+                co = co.toarray()
+
+        return projection.get_r(rmin,rmax,nr), xi, co
+    @profiling.staged('project')
+    def compute_wedges(self,mu_edges,rmin=0.,rmax=None,nr=None,ss=10,da=None):
+        '''
+            Wedges of the correlation, or of the models in da, for each range
+            mu_edges[i] <= mu <= mu_edges[i+1].
+            The bins are weighted by the inverse of the variance, or by the
+            weights if there is no covariance.
+            The covariance is multiplied once by the stacked matrices of all wedges.
+            Return r, the wedges (... x nwedges x nr) and their errors
+            (nwedges x nr), None if there is no covariance
+        '''
+
+        if rmax is None:
+            rmax = self._rt_max
+        if nr is None:
+            nr = self._nt
+
+        mat = [ projection.get_wedge_matrix(self._rp_min,self._rp_max,self._np,
+            self._rt_min,self._rt_max,self._nt,rmin,rmax,nr,mu_edges[i],mu_edges[i+1],ss)
+            for i in range(len(mu_edges)-1) ]
+        mat = sp.sparse.vstack(mat).tocsr()
+
+        co = self._co
+        we = sp.zeros(self._da.size)
+        if co is not None:
+            var = co.diagonal()
+            w = (var>0.)
+            we[w] = 1./var[w]
+        else:
+            we[:] = self._we
+
+        ### Normalized weights of each wedge bin
+        norm = mat.dot(we)
+        w = (norm>0.)
+        norm[w] = 1./norm[w]
+        mat = sp.sparse.diags(norm).dot(mat.dot(sp.sparse.diags(we))).tocsr()
+
+        if da is None:
+            da = self._da
+        da = sp.asarray(da)
+        d = mat.dot(da.T).T
+        d = d.reshape(da.shape[:-1]+(len(mu_edges)-1,nr))
+
+        er = None
+        if co is not None:
+            if isinstance(co,matrix.OffsetCovariance):
+                co = co.tocsr()
+            er = sp.asarray(mat.multiply(mat.dot(co)).sum(axis=1)).ravel()
+            er = sp.sqrt(er).reshape(len(mu_edges)-1,nr)
+
+        return projection.get_r(rmin,rmax,nr), d, er
+    def rebin(self,factor_p,factor_t):
+        '''
+            New correlation on a grid coarser by factor_p along rp and factor_t
+            along rt. The merged bins are averaged with the weights, or with
+            the inverse of the variance if there are no weights (export).
+            With P this weighted average, the covariance becomes P.C.P^T and
+            the distortion matrix P.DM.R^T, R^T copying the model of a new bin
+            to the merged bins
+        '''
+
+        assert(self._np%factor_p==0 and self._nt%factor_t==0)
+
+        if self._we is not None:
+            we = sp.asarray(self._we,dtype=float)
+        else:
+            var = self._co.diagonal()
+            we = sp.zeros(var.size)
+            w = (var>0.)
+            we[w] = 1./var[w]
+
+        mat = projection.get_rebin_matrix(self._np,self._nt,factor_p,factor_t)
+        proj, sum_we = projection.get_weighted_rebin_matrix(self._np,self._nt,factor_p,factor_t,we)
+
+        other = copy.copy(self)
+        other._loaders = {}
+        other._isotropic_index = {}
+        other._cholesky = None
+        other._distortion = None
+        other._path = None
+        other.set_grid({ 'NP':self._np//factor_p, 'NT':self._nt//factor_t,
+            'RTMAX':self._rt_max, 'RPMIN':self._rp_min, 'RPMAX':self._rp_max })
+
+        other._rp = proj.dot(self._rp)
+        other._rt = proj.dot(self._rt)
+        other._r  = sp.sqrt(other._rp**2. + other._rt**2.)
+        other._z  = proj.dot(self._z)
+        other._nb = mat.dot(self._nb)
+        other._we = None
+        if self._we is not None:
+            other._we = sum_we
+        other._da = None
+        if self._da is not None:
+            other._da = proj.dot(self._da)
+
+        other._co = None
+        other._er = None
+        if self._co is not None:
+            co = self._co
+            if isinstance(co,matrix.OffsetCovariance):
+                co = co.tocsr()
+            co = proj.dot(proj.dot(co).T)
+            if sp.sparse.issparse(co):
+                co = co.toarray()
+            other._co = co
+            other._er = other.get_errors_from_covariance()
+
+        other._dm = None
+        if '_dm' in self._loaders or self._dm is not None:
+            dm = self.get_distortion_matrix()
+            dm = proj.dot(mat.dot(dm.T).T)
+            if sp.sparse.issparse(dm):
+                dm = dm.toarray()
+            other._dm = dm
+
+        return other
+    def plot_2d(self,x_power=0,ax=None):
 
         if ((self._we>0.).sum()==0):
             print("no data")
             return
 
+        ax, show = utils.get_axes(ax)
+
         origin='lower'
         extent=[self._rt_min, self._rt_max, self._rp_min, self._rp_max]
         if (self._correlation=='o_f' or self._correlation=='f_f2'):
@@ -232,13 +720,11 @@ class Correlation3D:
 
         coef = sp.power(xxx,x_power)
 
-        fig = plt.figure()
-        ax = fig.add_subplot(111)
         #ax.set_xticks([ i for i in sp.arange(self._minX2D-50., self._maxX2D+50., 50.) ])
         #ax.set_yticks([ i for i in sp.arange(self._minY2D-50., self._maxY2D+50., 50.) ])
 
-        plt.imshow(coef*yyy, origin=origin,extent=extent, interpolation='nearest')
-        cbar = plt.colorbar()
+        im = ax.imshow(coef*yyy, origin=origin,extent=extent, interpolation='nearest')
+        cbar = ax.figure.colorbar(im,ax=ax)
 
         if (x_power==0):
             cbar.set_label(r'$\xi(\, r_{\parallel},r_{\perp} \,)$',size=40)
@@ -248,62 +734,40 @@ class Correlation3D:
             cbar.set_label(r'$|r|^{2}.\xi(\, r_{\parallel},r_{\perp} \,)$',size=40)
 
 
-        plt.xlabel(r'$r_{\perp} \, [h^{-1} \, \rm{Mpc}]$', fontsize=40)
-        plt.ylabel(r'$r_{\parallel} \, [h^{-1} \, \rm{Mpc}]$', fontsize=40)
-        plt.grid(True)
+        ax.set_xlabel(r'$r_{\perp} \, [h^{-1} \, \rm{Mpc}]$', fontsize=40)
+        ax.set_ylabel(r'$r_{\parallel} \, [h^{-1} \, \rm{Mpc}]$', fontsize=40)
+        ax.grid(True)
         cbar.formatter.set_powerlimits((0, 0))
         cbar.update_ticks()
 
-        plt.show()
+        return utils.show_axes(ax,show)
+    def plot_1d(self,x_power=0, other=None,ax=None):
 
-        return
-    def plot_1d(self,x_power=0, other=None):
+        ax, show = utils.get_axes(ax)
 
+        list_corr = [self]
         if not other is None:
-            list_corr = [self] + other
+            list_corr += other
 
         for el in list_corr:
-            r_max = sp.amax(el._r)
-            r_min = 0.
-            size = int((r_max-r_min)/el._binSize)
-
-            xxx = sp.zeros(size)
-            yyy = sp.zeros(size)
-            wee = sp.zeros(size)
-
-            we   = el._we
-            wer  = el._we*el._r
-            weda = el._we*el._da
-
-            for i in sp.arange(size):
-                cut = (el._r>i*el._binSize) & (el._r<(i+1)*el._binSize)
-                xxx[i] += sp.sum(wer[cut])
-                yyy[i] += sp.sum(weda[cut])
-                wee[i] += sp.sum(we[cut])
-            cut = wee>0.
-            xxx[cut] /= wee[cut]
-            yyy[cut] /= wee[cut]
-            cut = xxx<min(el._rp_max,el._rt_max)
-            xxx = xxx[cut]
-            yyy = yyy[cut]
-
-            coef = sp.power(xxx,x_power)
-            plt.errorbar(xxx,coef*yyy,marker='o',label=r'$'+el._title+'$')
-
-
-        plt.xlabel(r'$r \, [h^{-1} \, \mathrm{Mpc}]$',fontsize=30)
+            xxx, yyy, wee = el.compute_isotropic(x_power=x_power)
+            ax.errorbar(xxx,yyy,marker='o',label=r'$'+el._title+'$')
+
+
+        ax.set_xlabel(r'$r \, [h^{-1} \, \mathrm{Mpc}]$',fontsize=30)
         if (x_power==0):
-            plt.ylabel(r'$\xi$',fontsize=30)
+            ax.set_ylabel(r'$\xi$',fontsize=30)
         if (x_power==1):
-            plt.ylabel(r'$r \cdot \xi \, [h^{-1} \, \mathrm{Mpc}]$',fontsize=30)
+            ax.set_ylabel(r'$r \cdot \xi \, [h^{-1} \, \mathrm{Mpc}]$',fontsize=30)
         if (x_power==2):
-            plt.ylabel(r'$r^{2} \cdot \xi \, [(h^{-1} \, \mathrm{Mpc})^{2}]$',fontsize=30)
-        plt.legend(fontsize=20, numpoints=1,ncol=2, loc=1)
-        plt.grid()
-        plt.show()
+            ax.set_ylabel(r'$r^{2} \cdot \xi \, [(h^{-1} \, \mathrm{Mpc})^{2}]$',fontsize=30)
+        ax.legend(fontsize=20, numpoints=1,ncol=2, loc=1)
+        ax.grid()
 
-        return
-    def plot_slice_2d(self,sliceX=None,sliceY=None, other=None):
+        return utils.show_axes(ax,show)
+    def plot_slice_2d(self,sliceX=None,sliceY=None, other=None,ax=None):
+
+        ax, show = utils.get_axes(ax)
 
         list_corr = [self]
         if not other is None:
@@ -321,85 +785,72 @@ class Correlation3D:
                 yer = el._er[cut]
 
             if el._er is None:
-                plt.errorbar(xxx,yyy,linewidth=4,label=r'$'+el._title+'$',color='red')
+                ax.errorbar(xxx,yyy,linewidth=4,label=r'$'+el._title+'$',color='red')
             else:
-                plt.errorbar(xxx,yyy,yerr=yer,linewidth=4,label=r'$'+el._title+'$',color='black')
+                ax.errorbar(xxx,yyy,yerr=yer,linewidth=4,label=r'$'+el._title+'$',color='black')
 
         if (sliceX is not None):
             minX = el._rt_min+el._binSizeT*sliceX
             maxX = el._rt_min+el._binSizeT*(sliceX+1)
-            plt.title(r"$"+str(int(minX))+" < r_{\perp} < "+str(int(maxX))+"$",fontsize=30)
-            plt.xlabel(r'$r_{\parallel} \, [h^{-1} \, \mathrm{Mpc}]$',fontsize=30)
+            ax.set_title(r"$"+str(int(minX))+" < r_{\perp} < "+str(int(maxX))+"$",fontsize=30)
+            ax.set_xlabel(r'$r_{\parallel} \, [h^{-1} \, \mathrm{Mpc}]$',fontsize=30)
         if (sliceY is not None):
             minY = el._rp_min+el._binSizeP*sliceY
             maxY = el._rp_min+el._binSizeP*(sliceY+1)
-            plt.title(r"$"+str(minY)+" < r_{\parallel} < "+str(maxY)+"$",fontsize=30)
-            plt.xlabel(r'$r_{\perp} \, [h^{-1} \, \mathrm{Mpc}]$',fontsize=30)
-        plt.ylabel(r'$\xi^{qf}(r_{\parallel},r_{\perp})$',fontsize=30)
-        plt.legend(fontsize=30, numpoints=1,ncol=2, loc=1)
-        plt.grid()
-        plt.show()
+            ax.set_title(r"$"+str(minY)+" < r_{\parallel} < "+str(maxY)+"$",fontsize=30)
+            ax.set_xlabel(r'$r_{\perp} \, [h^{-1} \, \mathrm{Mpc}]$',fontsize=30)
+        ax.set_ylabel(r'$\xi^{qf}(r_{\parallel},r_{\perp})$',fontsize=30)
+        ax.legend(fontsize=30, numpoints=1,ncol=2, loc=1)
+        ax.grid()
 
-        return
-    def plot_wedge(self,x_power=0,mumin=-1.,mumax=1., other=None):
+        return utils.show_axes(ax,show)
+    def plot_wedge(self,x_power=0,mumin=-1.,mumax=1., other=None,ax=None):
+
+        ax, show = utils.get_axes(ax)
 
         list_corr = [self]
         if not other is None:
             list_corr += other
 
         for c in list_corr:
-            rpmin = c._rp_min
-            rpmax = c._rp_max
-            nrp   = c._np
-            rtmin = c._rt_min
-            rtmax = c._rt_max
-            nrt   = c._nt
-            rmin  = 0.
-            rmax  = c._rt_max
-            nr    = c._nt
-            ss    = 10
-            wed = wedgize.wedge(rpmin=rpmin,rpmax=rpmax,nrp=nrp,rtmin=rtmin,rtmax=rtmax,nrt=nrt,rmin=rmin,rmax=rmax,nr=nr,mumin=mumin,mumax=mumax,ss=ss)
-
-            r,d,ivar = wed.wedge(c._da,c._co)
-            e = sp.sqrt(sp.diag(ivar))
+            r,d,e = c.compute_wedges([mumin,mumax])
+            d = d[0]
             coef = sp.power(r,x_power)
+            if e is not None:
+                e = coef*e[0]
             if not c._isfit:
-                plt.errorbar(r,coef*d,yerr=coef*e,linewidth=4,label=r'$'+c._title+'$',color='black')
+                ax.errorbar(r,coef*d,yerr=e,linewidth=4,label=r'$'+c._title+'$',color='black')
             else:
-                plt.errorbar(r,coef*d,linewidth=4,label=r'$'+c._title+'$',color='red')
+                ax.errorbar(r,coef*d,linewidth=4,label=r'$'+c._title+'$',color='red')
 
-        plt.title(r"$"+str(mumin)+" < \mu < "+str(mumax)+"$",fontsize=30)
-        plt.xlabel(r'$r \, [h^{-1} \, \mathrm{Mpc}]$',fontsize=30)
+        ax.set_title(r"$"+str(mumin)+" < \mu < "+str(mumax)+"$",fontsize=30)
+        ax.set_xlabel(r'$r \, [h^{-1} \, \mathrm{Mpc}]$',fontsize=30)
         if (x_power==0):
-            plt.ylabel(r'$\xi^{qf}(r)$',fontsize=30)
+            ax.set_ylabel(r'$\xi^{qf}(r)$',fontsize=30)
         if (x_power==1):
-            plt.ylabel(r'$r \cdot \xi^{qf}(r) \, [h^{-1} \, \mathrm{Mpc}]$',fontsize=30)
+            ax.set_ylabel(r'$r \cdot \xi^{qf}(r) \, [h^{-1} \, \mathrm{Mpc}]$',fontsize=30)
         if (x_power==2):
-            plt.ylabel(r'$r^{2} \cdot \xi^{qf}(r) \, [(h^{-1} \, \mathrm{Mpc})^{2}]$',fontsize=30)
-        plt.legend(fontsize=30, numpoints=1,ncol=2)
-        plt.grid()
-        plt.tight_layout()
-        plt.show()
-
-        return
-    def plot_cov(self):
+            ax.set_ylabel(r'$r^{2} \cdot \xi^{qf}(r) \, [(h^{-1} \, \mathrm{Mpc})^{2}]$',fontsize=30)
+        ax.legend(fontsize=30, numpoints=1,ncol=2)
+        ax.grid()
+        if show:
+            ax.figure.tight_layout()
+
+        return utils.show_axes(ax,show)
+    def plot_cov(self,ax=None):
+        '''
+            Plot the mean of the diagonals of the correlation matrix.
+            A compact covariance gives the same curves as its dense matrix,
+            zero beyond the offsets it stores
+        '''
+
+        ax, show = utils.get_axes(ax)
 
         cov = self._co
-
-        if False:
-            ###
-            plt.plot(sp.diag(cov))
-            plt.grid()
-            plt.show()
-            ###
-            plt.plot(sp.diag(cov)*self._nb)
-            plt.grid()
-            plt.show()
-            ###
-            plt.plot(sp.diag(cov)*self._rt)
-            plt.grid()
-            plt.show()
-        if True:
+        if isinstance(cov,matrix.OffsetCovariance):
+            def cor_diagonal(d):
+                return cov.correlation_diagonal(d)
+        else:
             cor = utils.getCorrelationMatrix(cov)
             ###
             #tcor = cor.copy()
@@ -407,34 +858,216 @@ class Correlation3D:
             #plt.imshow(tcor, interpolation='nearest')
             #plt.show()
             ###
-            yMin = None
-            yMax = None
-            for i in range(3):
-                mcor = sp.asarray( [ sp.mean(sp.diag(cor,k=i+self._nt*k)) for k in sp.arange(self._np) ]  )
-                plt.plot(sp.arange(mcor.size)*self._binSize,mcor,linewidth=2,label=r"$\Delta r_{\perp} = "+str(int(i*self._binSize))+"$")
-
-                if yMin is None:
-                    yMin = mcor.min()
-                else:
-                    yMin = min(yMin,mcor.min())
-                if yMax is None:
-                    if i==0:
-                        yMax = mcor[1:].max()
-                    else:
-                        yMax = mcor.max()
-                else:
-                    if i==0:
-                        yMax = max(yMax,mcor[1:].max())
-                    else:
-                        yMax = max(yMax,mcor.max())
-            plt.ylim([yMin,yMax])
-            plt.xlabel(r"$\Delta r_{\parallel} \, [h^{-1} \, \mathrm{Mpc}]$",fontsize=20)
-            plt.ylabel(r"$\overline{Corr}(\Delta r_{\parallel},\Delta r_{\perp})$",fontsize=20)
-            plt.legend(fontsize=20, numpoints=1,ncol=2, loc=1)
-            plt.grid()
-            plt.tight_layout()
-            #plt.savefig(self._title)
-            #plt.clf()
-            plt.show()
-
-        return
+            def cor_diagonal(d):
+                return sp.diag(cor,k=d)
+        nbT = min(3,self._nt)
+        nbP = self._np
+
+        yMin = None
+        yMax = None
+        for i in range(nbT):
+            mcor = sp.asarray( [ sp.mean(cor_diagonal(i+self._nt*k)) for k in range(nbP) ]  )
+            ax.plot(sp.arange(mcor.size)*self._binSize,mcor,linewidth=2,label=r"$\Delta r_{\perp} = "+str(int(i*self._binSize))+"$")
+
+            if yMin is None:
+                yMin = mcor.min()
+            else:
+                yMin = min(yMin,mcor.min())
+            ### Without the main diagonal, unless it is the only one
+            if i==0 and mcor.size>1:
+                mcor = mcor[1:]
+            if yMax is None:
+                yMax = mcor.max()
+            else:
+                yMax = max(yMax,mcor.max())
+        ax.set_ylim([yMin,yMax])
+        ax.set_xlabel(r"$\Delta r_{\parallel} \, [h^{-1} \, \mathrm{Mpc}]$",fontsize=20)
+        ax.set_ylabel(r"$\overline{Corr}(\Delta r_{\parallel},\Delta r_{\perp})$",fontsize=20)
+        ax.legend(fontsize=20, numpoints=1,ncol=2, loc=1)
+        ax.grid()
+        if show:
+            ax.figure.tight_layout()
+
+        return utils.show_axes(ax,show)
+
+@profiling.staged('reduce')
+def read_sums_from_do_cor(path,read_da=True,block_size=None):
+    '''
+        Raw sums of a do_cor file: sum of the weights, weighted sums of
+        the correlation, rp, rt and z, and sum of the number of pairs
+    '''
+
+    vac = fitsio.FITS(path)
+
+    head = vac[1].read_header()
+    we, wda = utils.reduce_healpix(vac[2],read_da=read_da,block_size=block_size)
+
+    sums = {
+        'head' : utils.get_grid_header(head),
+        'WE'   : we,
+        'WDA'  : wda,
+        'WRP'  : vac[1]['RP'][:]*we,
+        'WRT'  : vac[1]['RT'][:]*we,
+        'WZ'   : vac[1]['Z'][:]*we,
+        'NB'   : vac[1]['NB'][:].astype(float),
+    }
+
+    vac.close()
+
+    return sums
+def add_sums(sums1,sums2):
+    '''
+        Add two sets of raw sums, in a new one
+    '''
+
+    assert(sums1['head']==sums2['head'])
+
+    sums = { 'head':sums1['head'] }
+    for k in ['WE','WDA','WRP','WRT','WZ','NB']:
+        if sums1[k] is None or sums2[k] is None:
+            sums[k] = None
+        else:
+            sums[k] = sums1[k]+sums2[k]
+
+    return sums
+def tree_sum(lst_sums):
+    '''
+        Pairwise sum of an iterable of raw sums.
+        Only O(log(n)) partial sums are kept in memory
+    '''
+
+    ### Partial sums of 2**level elements, as a binary counter
+    partial = []
+    for sums in lst_sums:
+        level = 0
+        while len(partial)>0 and partial[-1][0]==level:
+            sums = add_sums(partial.pop()[1],sums)
+            level += 1
+        partial += [(level,sums)]
+
+    if len(partial)==0:
+        return None
+
+    sums = partial.pop()[1]
+    while len(partial)>0:
+        sums = add_sums(partial.pop()[1],sums)
+
+    return sums
+def stack(paths,dic=None,workers=1,block_size=None):
+    '''
+        Stack the do_cor files in paths, read in parallel by workers processes.
+        The raw weighted sums are added pairwise and normalized once.
+        Return a new Correlation3D, built with the entries of dic
+    '''
+
+    if dic is None:
+        dic = copy.deepcopy(raw_dic_class)
+
+    read_da = dic['correlation'] not in ['o_o','o1_o2']
+    read = functools.partial(read_sums_from_do_cor,read_da=read_da,block_size=block_size)
+
+    if workers>1:
+        pool = multiprocessing.Pool(workers)
+        sums = tree_sum(pool.imap(read,paths))
+        pool.close()
+        pool.join()
+    else:
+        sums = tree_sum(read(p) for p in paths)
+
+    dic = copy.copy(dic)
+    dic['read'] = 'read_from_sums'
+    dic['path'] = sums
+
+    return Correlation3D(dic)
+def get_moments(paths,dic):
+    '''
+        Number, mean and sum of the outer products of the deviations
+        to the mean (M2) of the correlation of the realizations in paths,
+        read one at a time with the entries of dic and updated with
+        the algorithm of Welford. The grid (rp, rt, z, nb) is averaged
+    '''
+
+    moments = None
+    for p in paths:
+        dic_p = copy.copy(dic)
+        dic_p['path'] = p
+        c = Correlation3D(dic_p)
+        x = sp.asarray(c._da,dtype=float)
+
+        if moments is None:
+            head = utils.get_grid_header({ 'NT':c._nt, 'NP':c._np, 'RTMAX':c._rt_max,
+                'RPMIN':c._rp_min, 'RPMAX':c._rp_max })
+            moments = { 'head':head, 'n':0, 'mean':sp.zeros(x.size), 'M2':sp.zeros((x.size,x.size)),
+                'RP':sp.zeros(x.size), 'RT':sp.zeros(x.size), 'Z':sp.zeros(x.size), 'NB':sp.zeros(x.size) }
+            outer = sp.zeros((x.size,x.size))
+        assert(moments['mean'].size==x.size)
+
+        moments['n'] += 1
+        n = moments['n']
+        delta = x-moments['mean']
+        moments['mean'] += delta/n
+        sp.outer(delta,x-moments['mean'],out=outer)
+        moments['M2'] += outer
+        for k, v in [('RP',c._rp),('RT',c._rt),('Z',c._z),('NB',c._nb)]:
+            moments[k] += (v-moments[k])/n
+
+    return moments
+def merge_moments(moments1,moments2):
+    '''
+        Moments of the union of two sets of realizations,
+        with the pairwise update of Chan et al., in moments1
+    '''
+
+    if moments1 is None:
+        return moments2
+    if moments2 is None:
+        return moments1
+
+    assert(moments1['head']==moments2['head'])
+
+    n1 = moments1['n']
+    n2 = moments2['n']
+    n  = n1+n2
+    delta = moments2['mean']-moments1['mean']
+
+    moments1['M2'] += moments2['M2']
+    moments1['M2'] += sp.outer(delta,delta*(n1*n2/float(n)))
+    moments1['mean'] += delta*(n2/float(n))
+    for k in ['RP','RT','Z','NB']:
+        moments1[k] += (moments2[k]-moments1[k])*(n2/float(n))
+    moments1['n'] = n
+
+    return moments1
+def ensemble(paths,dic=None,workers=1):
+    '''
+        Mean and covariance of the realizations in paths, each read
+        with the entries of dic (e.g. dic['read']='read_from_export').
+        The realizations are split among workers processes, each reading
+        them one at a time with a running mean and covariance, and the
+        partial moments are merged. The memory is O(n_bins^2) per worker,
+        whatever the number of realizations.
+        Return a new Correlation3D with the mean as _da, the covariance
+        of one realization as _co, and _er
+    '''
+
+    assert(len(paths)>0)
+
+    if dic is None:
+        dic = copy.deepcopy(raw_dic_class)
+
+    if workers>1 and len(paths)>1:
+        chunks = [ paths[i::workers] for i in range(min(workers,len(paths))) ]
+        pool = multiprocessing.Pool(len(chunks))
+        moments = None
+        for m in pool.imap_unordered(functools.partial(get_moments,dic=dic),chunks):
+            moments = merge_moments(moments,m)
+        pool.close()
+        pool.join()
+    else:
+        moments = get_moments(paths,dic)
+
+    dic = copy.copy(dic)
+    dic['read'] = 'read_from_moments'
+    dic['path'] = moments
+
+    return Correlation3D(dic)
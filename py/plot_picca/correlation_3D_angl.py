@@ -1,10 +1,10 @@
 ### Python lib
-import fitsio
 import scipy as sp
 import copy
-import matplotlib.pyplot as plt
 import scipy.constants
-from . import utils, constants
+from . import utils, constants, cache, profiling, projection
+
+fitsio = utils.LazyModule('fitsio')
 
 raw_dic_class = {
     "correlation"             : "",
@@ -17,6 +17,8 @@ raw_dic_class = {
     "path"                    : None,
     "title"                   : "",
     "nside"                   : None,
+    "block_size"              : None,
+    "cache"                   : None,
 }
 
 class Correlation3D_angl:
@@ -38,6 +40,13 @@ class Correlation3D_angl:
         if "nside" not in dic.keys():
             dic["nside"] = 16
         self._nside = dic["nside"]
+        if "block_size" not in dic.keys():
+            dic["block_size"] = None
+        self._block_size = dic["block_size"]
+        if "cache" not in dic.keys():
+            dic["cache"] = None
+        self._cache = cache.get_cache(dic["cache"])
+        self._path  = None
 
         ### bin size (only square)
         self._rpmin    = None
@@ -101,11 +110,7 @@ class Correlation3D_angl:
 
         return
 
-    def read_from_do_cor(self,path):
-
-        vac = fitsio.FITS(path)
-
-        head = vac[1].read_header()
+    def set_grid(self,head):
 
         ### Grid
         self._nt = head['NT']
@@ -117,29 +122,84 @@ class Correlation3D_angl:
         self._binSizeP = (self._rp_max-self._rp_min) / self._np
         self._binSizeT = (self._rt_max-self._rt_min) / self._nt
 
-        self._rp = vac[1]['RP'][:]
-        self._rt = vac[1]['RT'][:]
-        self._z  = vac[1]['Z'][:]
-        self._nb = vac[1]['NB'][:]
+        return
+    def read_from_do_cor(self,path):
+
+        self._path = path
+
+        ### Reduced arrays from the cache
+        if self._cache is not None:
+            key = self._cache.key(path,['Correlation3D_angl.read_from_do_cor'])
+            cached = self._cache.load(key)
+            if cached is not None:
+                head, arrays = cached
+                self.set_grid(head)
+                self._rp = arrays['RP']
+                self._rt = arrays['RT']
+                self._z  = arrays['Z']
+                self._nb = arrays['NB']
+                self._we = arrays['WE']
+                self._da = arrays['DA']
+                return
+
+        with profiling.stage('open',path=path):
+            vac = fitsio.FITS(path)
+            head = vac[1].read_header()
+        self.set_grid(head)
+
+        with profiling.stage('read columns',path=path):
+            self._rp = vac[1]['RP'][:]
+            self._rt = vac[1]['RT'][:]
+            self._z  = vac[1]['Z'][:]
+            self._nb = vac[1]['NB'][:]
 
         ### Correlation
-        we  = vac[2]['WE'][:]
-        da  = vac[2]['DA'][:]
-        self._we = we.sum(axis=0)
+        self._we, self._da = utils.reduce_healpix(vac[2],block_size=self._block_size)
         cut = (self._we>0.)
-        self._da       = (da*we).sum(axis=0)
         self._da[cut] /= self._we[cut]
 
         vac.close()
 
+        if self._cache is not None:
+            head = utils.get_grid_header(head)
+            arrays = { 'RP':self._rp, 'RT':self._rt, 'Z':self._z, 'NB':self._nb, 'WE':self._we, 'DA':self._da }
+            self._cache.store(key,head,arrays)
+
         return
-    def plot_2d(self,log=False):
+    def rebin(self,factor_p,factor_t):
+        '''
+            New correlation on a grid coarser by factor_p along the
+            wavelength ratio and factor_t along the angle, the merged
+            bins being averaged with the weights
+        '''
+
+        assert(self._np%factor_p==0 and self._nt%factor_t==0)
+
+        mat = projection.get_rebin_matrix(self._np,self._nt,factor_p,factor_t)
+        proj, sum_we = projection.get_weighted_rebin_matrix(self._np,self._nt,factor_p,factor_t,sp.asarray(self._we,dtype=float))
+
+        other = copy.copy(self)
+        other._path = None
+        other.set_grid({ 'NP':self._np//factor_p, 'NT':self._nt//factor_t,
+            'RTMAX':self._rt_max, 'RPMIN':self._rp_min, 'RPMAX':self._rp_max })
+
+        other._rp = proj.dot(self._rp)
+        other._rt = proj.dot(self._rt)
+        other._z  = proj.dot(self._z)
+        other._nb = mat.dot(self._nb)
+        other._we = sum_we
+        other._da = proj.dot(self._da)
+
+        return other
+    def plot_2d(self,log=False,ax=None):
         crt = 1./scipy.constants.degree
 
         if ((self._we>0.).sum()==0):
             print("no data")
             return
 
+        ax, show = utils.get_axes(ax)
+
         origin='lower'
         extent=[crt*self._rt_min, crt*self._rt_max, self._rp_min, self._rp_max]
         if (self._correlation=='o_f' or self._correlation=='f_f2'):
@@ -153,33 +213,32 @@ class Correlation3D_angl:
             yyy[w] = sp.log10( sp.absolute(yyy[w]))
         yyy = utils.convert1DTo2D(yyy,self._np,self._nt)
 
-        fig = plt.figure()
-        ax = fig.add_subplot(111)
         ax.set_xticks([ i for i in sp.arange(crt*self._rt_min, crt*self._rt_max,crt*self._binSizeT*10) ])
         ax.set_yticks([ i for i in sp.arange(self._rp_min, self._rp_max,self._binSizeP*10) ])
 
-        plt.imshow(yyy, origin=origin, extent=extent, interpolation='nearest', aspect='auto')
-        cbar = plt.colorbar()
+        im = ax.imshow(yyy, origin=origin, extent=extent, interpolation='nearest', aspect='auto')
+        cbar = ax.figure.colorbar(im,ax=ax)
 
         if not log:
             cbar.set_label(r'$\xi(\lambda_{1}/\lambda_{2},\theta)$',size=40)
         else:
             cbar.set_label(r'$ \log10 \, |\xi(\lambda_{1}/\lambda_{2},\theta)| $',size=40)
 
-        plt.xlabel(r'$\theta \, [\mathrm{deg}]$', fontsize=40)
-        plt.ylabel(r'$\lambda_{1}/\lambda_{2}$', fontsize=40)
-        plt.grid(True)
+        ax.set_xlabel(r'$\theta \, [\mathrm{deg}]$', fontsize=40)
+        ax.set_ylabel(r'$\lambda_{1}/\lambda_{2}$', fontsize=40)
+        ax.grid(True)
         cbar.formatter.set_powerlimits((0, 0))
         cbar.update_ticks()
 
-        plt.show()
+        return utils.show_axes(ax,show)
+    def plot_slice_2d(self,sliceX=None,sliceY=None, other=None,coefX=1.,ax=None):
 
-        return
-    def plot_slice_2d(self,sliceX=None,sliceY=None, other=None,coefX=1.):
+        ax, show = utils.get_axes(ax)
 
         crt = 1./scipy.constants.degree
+        list_corr = [self]
         if not other is None:
-            list_corr = [self] + other
+            list_corr += other
 
         for el in list_corr:
 
@@ -198,9 +257,9 @@ class Correlation3D_angl:
                 yer = el._er[cut]
 
             if el._er is None:
-                plt.errorbar(coefX*xxx,yyy,linewidth=4,label=r'$'+el._title+'$')
+                ax.errorbar(coefX*xxx,yyy,linewidth=4,label=r'$'+el._title+'$')
             else:
-                plt.errorbar(coefX*xxx,yyy,yerr=yer,linewidth=4,label=r'$'+el._title+'$')
+                ax.errorbar(coefX*xxx,yyy,yerr=yer,linewidth=4,label=r'$'+el._title+'$')
             #minY = el._rp_min+el._binSizeP*sliceY
             #maxY = el._rp_min+el._binSizeP*(sliceY+1)
             #print str(minY)+" < \lambda_{1}/\lambda_{2} < "+str(maxY)
@@ -208,21 +267,20 @@ class Correlation3D_angl:
         if (sliceX is not None):
             minX = el._rt_min+el._binSizeT*sliceX
             maxX = el._rt_min+el._binSizeT*(sliceX+1)
-            plt.title(r"$"+str(minX)+" < \\theta < "+str(maxX)+"$",fontsize=30)
-            plt.xlabel(r'$\lambda_{1}/\lambda_{2}$',fontsize=30)
+            ax.set_title(r"$"+str(minX)+" < \\theta < "+str(maxX)+"$",fontsize=30)
+            ax.set_xlabel(r'$\lambda_{1}/\lambda_{2}$',fontsize=30)
         if (sliceY is not None):
             #minY = el._rp_min+el._binSizeP*sliceY
             #maxY = el._rp_min+el._binSizeP*(sliceY+1)
             #plt.title(r"$"+str(minY)+" < \lambda_{1}/\lambda_{2} < "+str(maxY)+"$",fontsize=30)
-            plt.xlabel(r'$\theta \, [\mathrm{deg}]$',fontsize=30)
+            ax.set_xlabel(r'$\theta \, [\mathrm{deg}]$',fontsize=30)
 
         for l in list(constants.absorber_IGM.keys()):
             l = constants.absorber_IGM[l]
-            plt.plot( [l,l], [-1.,1.], color='black' )
+            ax.plot( [l,l], [-1.,1.], color='black' )
 
-        plt.ylabel(r'$\xi$',fontsize=30)
+        ax.set_ylabel(r'$\xi$',fontsize=30)
         #plt.legend(fontsize=20, numpoints=1,ncol=2, loc=1)
-        plt.grid()
-        plt.show()
+        ax.grid()
 
-        return
+        return utils.show_axes(ax,show)
@@ -1,20 +1,113 @@
 ### Python lib
 from __future__ import print_function
+import numpy
 import scipy as sp
-import scipy.stats
 import copy
-import matplotlib.pyplot as plt
-import h5py
+import functools
+import collections
 import os.path
+import multiprocessing
 
 from . import utils
 from . import constants
+from . import profiling
+
+h5py  = utils.LazyModule('h5py')
+stats = utils.LazyModule('scipy.stats')
 
 raw_dic_class = {
     'path' :'',
     'title':''
 }
 
+### Attributes of 'best fit' that are not parameters
+lst_forFit = ['cov[','ndata', 'npar', 'list of free pars', 'list of fixed pars',
+            'hesse_failed', 'has_reached_call_limit', 'has_accurate_covar', 'has_posdef_covar',
+            'up', 'fval', 'is_valid', 'is_above_max_edm', 'has_covariance', 'has_made_posdef_covar',
+            'has_valid_parameters', 'edm', 'nfcn', 'zeff']
+
+def read_best_fit(attrs):
+    '''
+        Parameters and fit attributes from the attributes of the 'best fit' group
+    '''
+
+    param    = {}
+    fitAtrrs = {}
+    for el in attrs:
+        if any( str(ell) in el for ell in lst_forFit):
+            if str(el)=='list of free pars' or str(el)=='list of fixed pars':
+                fitAtrrs[str(el)]=sp.array([ ell for ell in attrs[el]]).astype(str)
+            else:
+                fitAtrrs[str(el)]=attrs[el]
+        else:
+            param[str(el)] = {}
+            param[str(el)]['value'] = attrs[el][0]
+            param[str(el)]['error'] = attrs[el][1]
+            if str(el) in list(constants.latex_name.keys()):
+                param[str(el)]['name'] = constants.latex_name[str(el)]
+            else:
+                param[str(el)]['name'] = str(el)
+
+    ### Set errors to zero for unfitted param
+    for el in fitAtrrs['list of fixed pars']:
+        param[el]['error'] = 0.
+
+    ### Set proba
+    fitAtrrs['proba'] = 1.-stats.chi2.cdf(fitAtrrs['fval'],fitAtrrs['ndata']-fitAtrrs['npar'])
+
+    return param, fitAtrrs
+
+### Open HDF5 files, kept open to read the lazy datasets.
+### At most max_open_files are open, the least recently used is closed first
+_files = collections.OrderedDict()
+max_open_files = 32
+
+@profiling.staged('open')
+def get_file(path):
+    '''
+        Open HDF5 file at path, from the pool of open files.
+        A file closed to stay under max_open_files is opened again on demand
+    '''
+
+    if path in _files and _files[path]:
+        _files.move_to_end(path)
+        return _files[path]
+
+    _files.pop(path,None)
+    _files[path] = h5py.File(path,'r')
+    while len(_files)>max_open_files:
+        _, f = _files.popitem(last=False)
+        if f:
+            f.close()
+
+    return _files[path]
+def close_files():
+    '''
+        Close all the files of the pool
+    '''
+
+    for f in _files.values():
+        if f:
+            f.close()
+    _files.clear()
+
+    return
+@profiling.staged('read columns')
+def read_dataset(path,name):
+
+    return get_file(path)[name][()]
+def read_fastmc_errors(path,par,dic,fixed):
+    '''
+        Errors of the fast Monte-Carlo on par, set to zero if par is fixed
+        in the fit or in the fiducial parameters
+    '''
+
+    errors = read_dataset(path,'fast mc/'+par+'/errors')
+    if fixed or dic['fixed']:
+        errors[:] = 0.
+
+    return errors
+
 class Fit:
 
     def __init__(self,dic=None):
@@ -30,34 +123,12 @@ class Fit:
     def read_fit_results(self,path):
 
         path = os.path.expandvars(path)
-        f = h5py.File(path,'r')
+        self._path = path
+        f = get_file(path)
 
         ### Parameters
-        self._param    = {}
-        self._fitAtrrs = {}
+        self._param, self._fitAtrrs = read_best_fit(f['best fit'].attrs)
         self._fit      = {}
-        lst_forFit = ['cov[','ndata', 'npar', 'list of free pars', 'list of fixed pars',
-                    'hesse_failed', 'has_reached_call_limit', 'has_accurate_covar', 'has_posdef_covar',
-                    'up', 'fval', 'is_valid', 'is_above_max_edm', 'has_covariance', 'has_made_posdef_covar',
-                    'has_valid_parameters', 'edm', 'nfcn', 'zeff']
-        for el in f['best fit'].attrs:
-            if any( str(ell) in el for ell in lst_forFit):
-                if str(el)=='list of free pars' or str(el)=='list of fixed pars':
-                    self._fitAtrrs[str(el)]=sp.array([ ell for ell in f['best fit'].attrs[el]]).astype(str)
-                else:
-                    self._fitAtrrs[str(el)]=f['best fit'].attrs[el]
-            else:
-                self._param[str(el)] = {}
-                self._param[str(el)]['value'] = f['best fit'].attrs[el][0]
-                self._param[str(el)]['error'] = f['best fit'].attrs[el][1]
-                if str(el) in list(constants.latex_name.keys()):
-                    self._param[str(el)]['name'] = constants.latex_name[str(el)]
-                else:
-                    self._param[str(el)]['name'] = str(el)
-
-        ### Set errors to zero for unfitted param
-        for el in self._fitAtrrs['list of fixed pars']:
-            self._param[el]['error'] = 0.
 
         ### Convert from bias*f/beta to bias
         #for p in list(self._param.keys()):
@@ -70,18 +141,15 @@ class Fit:
         #        self._param[p]['error'] *= coef
         #        print(p, self._param[p]['value'], self._param[p]['error'])
 
-        ### Set proba
-        self._fitAtrrs['proba'] = 1.-sp.stats.chi2.cdf(self._fitAtrrs['fval'],self._fitAtrrs['ndata']-self._fitAtrrs['npar'])
-
-        ### Best fit
-        self._data = {}
+        ### Best fit, the datasets are read on first access
+        self._data = utils.LazyDict()
         for d in f.keys():
             if d in ['best fit','fast mc','minos','chi2 scan']: continue
 
-            dic = {}
+            dic = utils.LazyDict()
             for item, value in f[d].attrs.items():
                 dic[str(item)] = value
-            dic['fit'] = f[d]['fit'].value
+            dic.set_loader('fit',functools.partial(read_dataset,path,d+'/fit'))
             self._data[str(d)] = dic
 
         ### minos
@@ -97,7 +165,7 @@ class Fit:
         ### chi2 scan
         if 'chi2 scan' in [ el for el in list(f.keys())]:
             self.chi2scan = {}
-            self.chi2scan_result = {}
+            self.chi2scan_result = utils.LazyDict()
             for p in f['chi2 scan'].keys():
                 if p!='result':
                     dic = {}
@@ -108,33 +176,40 @@ class Fit:
                     self.chi2scan_result['parameters'] = {}
                     for item, value in f['chi2 scan'][p].attrs.items():
                         self.chi2scan_result['parameters'][str(item)] = value
-                    self.chi2scan_result['values'] = f['chi2 scan']['result']['values'].value
+                    self.chi2scan_result.set_loader('values',functools.partial(read_dataset,path,'chi2 scan/result/values'))
 
         ### fast mc
         if 'fast mc' in [ el for el in list(f.keys())]:
-            self.fastmc = {}
+            self.fastmc = utils.LazyDict()
             self.fastmc['niterations'] = f['fast mc'].attrs['niterations']
             self.fastmc['seed'] = f['fast mc'].attrs['seed']
             self.fastmc['covscaling'] = f['fast mc'].attrs['covscaling']
-            self.fastmc['chi2'] = f['fast mc/chi2'].value
+            self.fastmc.set_loader('chi2',functools.partial(read_dataset,path,'fast mc/chi2'))
             for p in self._param:
                 strp = str(p)
-                self.fastmc[strp] = {}
-                self.fastmc[strp]['values'] = f['fast mc/'+p+'/values'].value
-                self.fastmc[strp]['errors'] = f['fast mc/'+p+'/errors'].value
-                self.fastmc[strp]['expected'] = self._param[strp]['value']
-                self.fastmc[strp]['fixed'] = strp in self._fitAtrrs['list of fixed pars']
-                if self.fastmc[strp]['fixed']:
-                    self.fastmc[strp]['errors'][:] = 0.
+                dic = utils.LazyDict()
+                dic.set_loader('values',functools.partial(read_dataset,path,'fast mc/'+p+'/values'))
+                dic['expected'] = self._param[strp]['value']
+                dic['fixed'] = strp in self._fitAtrrs['list of fixed pars']
+                dic.set_loader('errors',functools.partial(read_fastmc_errors,path,p,dic,dic['fixed']))
+                self.fastmc[strp] = dic
             for p in f['fast mc'].attrs['list of fiducial pars']:
                 self.fastmc[str(p)]['expected'] = float(f['fast mc'].attrs['fiducial['+p+']'][0])
                 self.fastmc[str(p)]['fixed'] = f['fast mc'].attrs['fiducial['+p+']'][1]=='fixed'
-                if self.fastmc[str(p)]['fixed']:
-                    self.fastmc[str(p)]['errors'][:] = 0.
-        f.close()
 
         return
-    def plot_chi2scan(self,deltachi2=True,sigmas=True):
+    def close(self):
+        '''
+            Close the file, it is opened again if a dataset not read yet is accessed
+        '''
+
+        if self._path in _files:
+            _files.pop(self._path).close()
+
+        return
+    def plot_chi2scan(self,deltachi2=True,sigmas=True,ax=None):
+
+        ax, show = utils.get_axes(ax)
 
         if deltachi2:
             zlabel = '\Delta \chi^{2}'
@@ -152,14 +227,13 @@ class Fit:
             if deltachi2:
                 zzz -= self._fitAtrrs['fval']
 
-            plt.plot(xxx,zzz,linewidth=4)
+            ax.plot(xxx,zzz,linewidth=4)
             if sigmas:
                 for i in range(1,4):
-                    plt.plot(xxx,i**2*sp.ones(xxx.size),'--',linewidth=4,color='grey')
-            plt.xlabel(r'$'+constants.latex_name[par]+'$',fontsize=30)
-            plt.ylabel(r'$'+zlabel+'$',fontsize=30)
-            plt.grid()
-            plt.show()
+                    ax.plot(xxx,i**2*sp.ones(xxx.size),'--',linewidth=4,color='grey')
+            ax.set_xlabel(r'$'+constants.latex_name[par]+'$',fontsize=30)
+            ax.set_ylabel(r'$'+zlabel+'$',fontsize=30)
+            ax.grid()
         elif dim==2:
             par1 = self.chi2scan.keys()[0]
             par2 = self.chi2scan.keys()[1]
@@ -171,18 +245,75 @@ class Fit:
             if deltachi2:
                 zzz -= self._fitAtrrs['fval']
 
-            plt.imshow(zzz,extent=extent,origin='lower',interpolation='nearest')
-            cbar = plt.colorbar()
-            plt.xlabel(r'$'+constants.latex_name[par2]+'$', fontsize=30)
-            plt.ylabel(r'$'+constants.latex_name[par1]+'$', fontsize=30)
+            im = ax.imshow(zzz,extent=extent,origin='lower',interpolation='nearest')
+            cbar = ax.figure.colorbar(im,ax=ax)
+            ax.set_xlabel(r'$'+constants.latex_name[par2]+'$', fontsize=30)
+            ax.set_ylabel(r'$'+constants.latex_name[par1]+'$', fontsize=30)
             cbar.set_label(r'$'+zlabel+'$',size=30)
-            plt.grid(True)
+            ax.grid(True)
             cbar.formatter.set_powerlimits((0, 0))
             cbar.update_ticks()
-            plt.show()
 
-        return
-    def plot_fastMC(self, par):
+        return utils.show_axes(ax,show)
+    def get_fastMC_stats(self,lst=None,nboot=1000,seed=None,chunk_size=100):
+        '''
+            Statistics of the fast Monte-Carlo for all the parameters in lst
+            (default: the free parameters) at once:
+            mean, variance, error on the mean, rms with respect to the expected value,
+            mean and variance of the pull, covariance and correlation matrices,
+            and bootstrap errors (nboot resamplings of the iterations)
+            on the mean, variance, pull mean and pull variance
+        '''
+
+        if lst is None:
+            lst = list(self._fitAtrrs['list of free pars'])
+
+        values   = sp.column_stack([ self.fastmc[p]['values'] for p in lst ])
+        errors   = sp.column_stack([ self.fastmc[p]['errors'] for p in lst ])
+        expected = sp.array([ float(self.fastmc[p]['expected']) for p in lst ])
+        pull     = (values-expected)/errors
+        nb       = values.shape[0]
+
+        cov = sp.atleast_2d(sp.cov(values,rowvar=False))
+        res = {
+            'parameters'    : lst,
+            'niterations'   : nb,
+            'expected'      : expected,
+            'mean'          : values.mean(axis=0),
+            'variance'      : values.var(axis=0,ddof=1),
+            'error_mean'    : sp.sqrt(values.var(axis=0,ddof=1)/nb),
+            'rms_expected'  : sp.sqrt( sp.mean((values-expected)**2,axis=0) ),
+            'pull_mean'     : pull.mean(axis=0),
+            'pull_variance' : pull.var(axis=0,ddof=1),
+            'covariance'    : cov,
+            'correlation'   : utils.getCorrelationMatrix(cov),
+        }
+
+        ### Bootstrap, with the number of times each iteration is drawn
+        rng = numpy.random.RandomState(seed)
+        boot = { k:[] for k in ['mean','variance','pull_mean','pull_variance'] }
+        for start in range(0,nboot,chunk_size):
+            counts = rng.multinomial(nb,sp.ones(nb)/nb,size=min(chunk_size,nboot-start)).astype(float)
+            for name, x in [('',values),('pull_',pull)]:
+                xc = x-x.mean(axis=0)
+                m  = counts.dot(xc)/nb
+                m2 = counts.dot(xc**2)/nb
+                boot[name+'mean']     += [ m+x.mean(axis=0) ]
+                boot[name+'variance'] += [ (m2-m**2)*nb/(nb-1.) ]
+        for k in boot:
+            res[k+'_error_boot'] = sp.concatenate(boot[k]).std(axis=0,ddof=1)
+
+        return res
+    def plot_fastMC(self, par, axs=None):
+        '''
+            Plot the histograms of the values, pulls and errors of par.
+            axs: list of the three axes to draw into, or None for three new figures.
+            Return the three figures
+        '''
+
+        if axs is None:
+            axs = [None,None,None]
+        figs = []
 
         ###
         if par=='chi2':
@@ -215,34 +346,37 @@ class Fit:
         print(' variance pull  = ', pull.var(ddof=1) )
 
         ### histo value
-        plt.hist(value,bins=10)
-        plt.plot([expected,expected],[0.,value.size], color='red',linewidth=4)
-        plt.plot([data,data],[0.,value.size],'--', color='black',linewidth=4)
-        plt.xlabel(r'$'+name+'$',fontsize=20)
-        plt.ylabel(r'$\#$',fontsize=20)
-        plt.grid()
-        plt.show()
+        ax, show = utils.get_axes(axs[0])
+        ax.hist(value,bins=10)
+        ax.plot([expected,expected],[0.,value.size], color='red',linewidth=4)
+        ax.plot([data,data],[0.,value.size],'--', color='black',linewidth=4)
+        ax.set_xlabel(r'$'+name+'$',fontsize=20)
+        ax.set_ylabel(r'$\#$',fontsize=20)
+        ax.grid()
+        figs += [utils.show_axes(ax,show)]
 
         ### histo pull
-        plt.hist(pull,bins=10)
-        plt.plot([0.,0.],[0.,value.size], color='red',linewidth=4)
-        plt.plot([pull_data,pull_data],[0.,value.size],'--', color='black',linewidth=4)
-        plt.xlabel(r'$('+name+'-exp)/err$',fontsize=20)
-        plt.ylabel(r'$\#$',fontsize=20)
-        plt.grid()
-        plt.show()
+        ax, show = utils.get_axes(axs[1])
+        ax.hist(pull,bins=10)
+        ax.plot([0.,0.],[0.,value.size], color='red',linewidth=4)
+        ax.plot([pull_data,pull_data],[0.,value.size],'--', color='black',linewidth=4)
+        ax.set_xlabel(r'$('+name+'-exp)/err$',fontsize=20)
+        ax.set_ylabel(r'$\#$',fontsize=20)
+        ax.grid()
+        figs += [utils.show_axes(ax,show)]
 
         ### histo error
-        plt.hist(errors,bins=10, histtype='step', label=r'$\mathrm{'+self._title+'}$',color='blue')
-        plt.plot([errors.mean(),errors.mean()],[0.,value.size],'--', color='blue',linewidth=2)
-        plt.plot([error_data,error_data],[0.,value.size],'--', color='black',linewidth=2,label=r'$\mathrm{Data}$')
-        plt.xlabel(r'$\sigma('+name+')$',fontsize=40)
-        plt.ylabel(r'$\#$',fontsize=40)
-        plt.legend(fontsize=40)
-        plt.grid()
-        plt.show()
-
-        return
+        ax, show = utils.get_axes(axs[2])
+        ax.hist(errors,bins=10, histtype='step', label=r'$\mathrm{'+self._title+'}$',color='blue')
+        ax.plot([errors.mean(),errors.mean()],[0.,value.size],'--', color='blue',linewidth=2)
+        ax.plot([error_data,error_data],[0.,value.size],'--', color='black',linewidth=2,label=r'$\mathrm{Data}$')
+        ax.set_xlabel(r'$\sigma('+name+')$',fontsize=40)
+        ax.set_ylabel(r'$\#$',fontsize=40)
+        ax.legend(fontsize=40)
+        ax.grid()
+        figs += [utils.show_axes(ax,show)]
+
+        return figs
     def print_fitted_par(self,lst=None,coeffBias=1.,header=True,latex=False,redshift=False):
 
         if not latex:
@@ -329,7 +463,7 @@ class Fit:
             val = chi2
             err = 0.1
             val = utils.format_number_with_precision(val,err)
-            proba = 1.-sp.stats.chi2.cdf(chi2,nbBin-nbParam)
+            proba = 1.-stats.chi2.cdf(chi2,nbBin-nbParam)
             proba = utils.format_number_with_precision(proba,proba)
             s = val + ' / (' + str(nbBin) + '-' + str(nbParam) + '),  p = ' + proba
 
@@ -345,3 +479,131 @@ class Fit:
             print(d,chi2)
 
         return
+
+def read_best_fit_summary(path):
+    '''
+        Best fit values and errors of the parameters, and fit summary,
+        of the fit results at path
+    '''
+
+    f = h5py.File(os.path.expandvars(path),'r')
+    param, fitAtrrs = read_best_fit(f['best fit'].attrs)
+    f.close()
+
+    summary = { 'path':path, 'param':{} }
+    for p in param:
+        summary['param'][p] = (param[p]['value'],param[p]['error'])
+    for el in ['fval','ndata','npar','proba','zeff']:
+        summary[el] = fitAtrrs.get(el,sp.nan)
+
+    return summary
+
+class FitCollection:
+    '''
+        Best fit results of many fits, in one structured array with
+        one row per fit and the columns
+            path, title, values, errors, fval, ndata, npar, proba, zeff
+        values and errors hold one column per parameter, in the order of
+        self._parameters, with nan for parameters missing from a fit.
+        The files are read in parallel by workers processes
+    '''
+
+    def __init__(self,paths=None,titles=None,workers=1):
+
+        self._parameters = []
+        self._table = None
+
+        if paths is None:
+            return
+        if titles is None:
+            titles = [ os.path.basename(p) for p in paths ]
+
+        if workers>1:
+            pool = multiprocessing.Pool(workers)
+            lst = pool.map(read_best_fit_summary,paths)
+            pool.close()
+            pool.join()
+        else:
+            lst = [ read_best_fit_summary(p) for p in paths ]
+
+        self._parameters = sorted(set( p for el in lst for p in el['param'] ))
+        npar = len(self._parameters)
+        lenstr = max([1]+[ len(p) for p in paths ]+[ len(t) for t in titles ])
+        dtype = [ ('path','U'+str(lenstr)), ('title','U'+str(lenstr)),
+            ('values','f8',(npar,)), ('errors','f8',(npar,)),
+            ('fval','f8'), ('ndata','i8'), ('npar','i8'), ('proba','f8'), ('zeff','f8') ]
+
+        self._table = sp.zeros(len(lst),dtype=dtype)
+        self._table['values'] = sp.nan
+        self._table['errors'] = sp.nan
+        for i, el in enumerate(lst):
+            self._table['path'][i]  = el['path']
+            self._table['title'][i] = titles[i]
+            for j, p in enumerate(self._parameters):
+                if p in el['param']:
+                    self._table['values'][i,j] = el['param'][p][0]
+                    self._table['errors'][i,j] = el['param'][p][1]
+            for c in ['fval','ndata','npar','proba','zeff']:
+                self._table[c][i] = el[c]
+
+        return
+
+    def __len__(self):
+
+        return self._table.size
+    def __getitem__(self,key):
+
+        return self._table[key]
+    def get_values(self,par):
+
+        return self._table['values'][:,self._parameters.index(par)]
+    def get_errors(self,par):
+
+        return self._table['errors'][:,self._parameters.index(par)]
+    def select(self,mask):
+        '''
+            New collection with the fits selected by mask (boolean or indices)
+        '''
+
+        other = FitCollection()
+        other._parameters = list(self._parameters)
+        other._table = self._table[mask]
+
+        return other
+    def sort(self,key,par=None,reverse=False):
+        '''
+            New collection sorted by the column key,
+            or by the values or errors of the parameter par
+        '''
+
+        if par is None:
+            col = self._table[key]
+        else:
+            col = self._table[key][:,self._parameters.index(par)]
+
+        idx = sp.argsort(col,kind='mergesort')
+        if reverse:
+            idx = idx[::-1]
+
+        return self.select(idx)
+    def summary(self,lst=None):
+        '''
+            Mean, standard deviation, median, minimum and maximum
+            of the values and errors of the parameters in lst,
+            and of fval and proba
+        '''
+
+        if lst is None:
+            lst = self._parameters
+
+        def describe(x):
+            return { 'mean':sp.nanmean(x), 'std':sp.nanstd(x,ddof=1), 'median':sp.nanmedian(x),
+                'min':sp.nanmin(x), 'max':sp.nanmax(x) }
+
+        summary = {}
+        for p in lst:
+            summary[p] = { 'values':describe(self.get_values(p)), 'errors':describe(self.get_errors(p)) }
+        for c in ['fval','proba']:
+            summary[c] = describe(self._table[c])
+
+        return summary
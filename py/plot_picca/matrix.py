@@ -0,0 +1,252 @@
+### Python lib
+import numpy
+import scipy as sp
+import scipy.sparse
+import scipy.linalg
+
+def pack(mat,nband=None,lower=False):
+    '''
+        Pack the upper (or lower) triangle of the square matrix mat,
+        keeping the nband first diagonals
+    '''
+
+    n = mat.shape[0]
+    if nband is None:
+        nband = n
+
+    if lower:
+        data = sp.concatenate([ sp.diagonal(mat,-k) for k in range(nband) ])
+    else:
+        data = sp.concatenate([ sp.diagonal(mat,k) for k in range(nband) ])
+
+    return PackedTriangular(data,n,nband,lower)
+
+class PackedTriangular:
+    '''
+        Upper (or lower) triangle of a square matrix of size n, restricted
+        to its nband first diagonals.
+        The diagonals k=0..nband-1 are stored one after the other in data,
+        the diagonal k starting at starts[k].
+        nband=n is the packed triangle, nband<n a band around the diagonal.
+    '''
+
+    def __init__(self,data,n,nband,lower=False):
+
+        self.data  = data
+        self.n     = n
+        self.nband = nband
+        self.lower = lower
+
+        k = sp.arange(nband)
+        self.starts = k*n-k*(k-1)//2
+
+        return
+
+    def diagonal(self,k=0):
+        '''
+            Diagonal k of the full matrix, k=j-i as in scipy.diag
+        '''
+
+        if self.lower:
+            k = -k
+        if k<0:
+            return sp.zeros(self.n+k)
+        if k>=self.nband:
+            return sp.zeros(self.n-k)
+
+        return self.data[self.starts[k]:self.starts[k]+self.n-k]
+    def diagonal_sums(self):
+        '''
+            Sum of each stored diagonal, from the main one outward.
+            The ufunc is the one of numpy, scipy.add being a plain
+            function since scipy 1.4
+        '''
+
+        return numpy.add.reduceat(self.data,self.starts)
+    def multiply(self,other):
+        '''
+            Element-wise product with a packed matrix of the same layout
+        '''
+
+        assert(self.n==other.n and self.nband==other.nband and self.lower==other.lower)
+
+        return PackedTriangular(self.data*other.data,self.n,self.nband,self.lower)
+    def trace(self):
+
+        return self.diagonal(0).sum()
+    def dense(self):
+        '''
+            Full matrix, with zeros outside of the stored diagonals
+        '''
+
+        mat = sp.zeros((self.n,self.n),dtype=self.data.dtype)
+        for k in range(self.nband):
+            i = sp.arange(self.n-k)
+            if self.lower:
+                mat[i+k,i] = self.data[self.starts[k]:self.starts[k]+self.n-k]
+            else:
+                mat[i,i+k] = self.data[self.starts[k]:self.starts[k]+self.n-k]
+
+        return mat
+def compress(rows,np,nt,max_dp=None,max_dt=None):
+    '''
+        Compact covariance of a correlation on a grid of np x nt bins,
+        from its blocks of rows, given by rows as (first row, block).
+        The covariances at an offset |Delta rp|>max_dp or |Delta rt|>max_dt
+        bins are dropped
+    '''
+
+    if max_dp is None:
+        max_dp = np-1
+    if max_dt is None:
+        max_dt = nt-1
+    max_dp = min(max_dp,np-1)
+    max_dt = min(max_dt,nt-1)
+
+    offsets = [ (0,dt) for dt in range(max_dt+1) ]
+    offsets += [ (dp,dt) for dp in range(1,max_dp+1) for dt in range(-max_dt,max_dt+1) ]
+    data = sp.zeros((len(offsets),np*nt))
+
+    for start, block in rows:
+        i  = start+sp.arange(block.shape[0])
+        ip = i//nt
+        it = i%nt
+        for k, (dp,dt) in enumerate(offsets):
+            w = (ip+dp<np) & (it+dt>=0) & (it+dt<nt)
+            data[k,i[w]] = block[sp.arange(i.size)[w],i[w]+dp*nt+dt]
+
+    return OffsetCovariance(data,offsets,np,nt)
+
+class OffsetCovariance:
+    '''
+        Covariance of a correlation on a grid of np x nt bins, the bin
+        i = ip*nt+it, keyed by the offset (Delta rp, Delta rt) in bins
+        between the two bins.
+        data[k,i] is the covariance of the bin i with the bin at the
+        offset offsets[k], zero if outside of the grid. Only the offsets
+        with Delta rp>0, or Delta rp=0 and Delta rt>=0, are stored, the
+        others by symmetry. The covariance is thus banded, with
+        nt*max_dp+max_dt diagonals above the main one.
+        A truncated covariance is not always positive definite.
+    '''
+
+    def __init__(self,data,offsets,np,nt):
+
+        self.data    = data
+        self.offsets = list(offsets)
+        self.np      = np
+        self.nt      = nt
+        self.n       = np*nt
+        self.shape   = (self.n,self.n)
+
+        self.max_dp = max( dp for dp, dt in self.offsets )
+        self.max_dt = max( abs(dt) for dp, dt in self.offsets )
+        self.nband  = self.max_dp*nt+self.max_dt
+
+        self._csr      = None
+        self._cholesky = None
+
+        return
+
+    def get(self,dp,dt):
+        '''
+            Covariance of each bin with the bin at the offset (dp,dt)
+        '''
+
+        return self.data[self.offsets.index((dp,dt))]
+    def diagonal(self):
+
+        return self.get(0,0)
+    def correlation_diagonal(self,k=0):
+        '''
+            Diagonal k>=0 of the correlation matrix, equal to
+            scipy.diag(utils.getCorrelationMatrix(self.dense()),k)
+            without the dense matrix: zero for the pairs of bins at an
+            offset not stored, or with a null variance.
+            The pairs (i,i+k) are at the offset (k//nt,k%nt), or, when
+            i+k wraps to the next row of rp, (k//nt+1,k%nt-nt)
+        '''
+
+        var = self.diagonal()
+        inv = sp.zeros(self.n)
+        w = (var>0.)
+        inv[w] = 1./sp.sqrt(var[w])
+
+        i  = sp.arange(max(self.n-k,0))
+        wrap = (i%self.nt+k%self.nt>=self.nt)
+        diag = sp.zeros(i.size)
+        for offset, sel in [((k//self.nt,k%self.nt),~wrap), ((k//self.nt+1,k%self.nt-self.nt),wrap)]:
+            if offset not in self.offsets or not sel.any():
+                continue
+            a = i[sel]
+            diag[sel] = self.get(*offset)[a]*inv[a]*inv[a+k]
+        if k==0:
+            diag[w] = 1.
+
+        return diag
+    def tocsr(self):
+        '''
+            Sparse matrix in CSR format, cached
+        '''
+
+        if self._csr is not None:
+            return self._csr
+
+        i  = sp.arange(self.n)
+        ip = i//self.nt
+        it = i%self.nt
+        rows = []
+        cols = []
+        vals = []
+        for k, (dp,dt) in enumerate(self.offsets):
+            w = (ip+dp<self.np) & (it+dt>=0) & (it+dt<self.nt)
+            j = i[w]+dp*self.nt+dt
+            rows += [i[w]]
+            cols += [j]
+            vals += [self.data[k,w]]
+            if (dp,dt)!=(0,0):
+                rows += [j]
+                cols += [i[w]]
+                vals += [self.data[k,w]]
+
+        self._csr = sp.sparse.coo_matrix((sp.concatenate(vals),(sp.concatenate(rows),sp.concatenate(cols))),
+            shape=self.shape).tocsr()
+
+        return self._csr
+    def dot(self,x):
+
+        return self.tocsr().dot(x)
+    def dense(self):
+
+        return self.tocsr().toarray()
+    def banded(self):
+        '''
+            Upper banded form ab[nband+i-j,j] = C[i,j] for i<=j,
+            as used by scipy.linalg.cholesky_banded
+        '''
+
+        ab = sp.zeros((self.nband+1,self.n))
+        i  = sp.arange(self.n)
+        ip = i//self.nt
+        it = i%self.nt
+        for k, (dp,dt) in enumerate(self.offsets):
+            w = (ip+dp<self.np) & (it+dt>=0) & (it+dt<self.nt)
+            d = dp*self.nt+dt
+            ab[self.nband-d,i[w]+d] = self.data[k,w]
+
+        return ab
+    def cholesky(self):
+        '''
+            Upper banded Cholesky factor, cached
+        '''
+
+        if self._cholesky is None:
+            self._cholesky = sp.linalg.cholesky_banded(self.banded(),lower=False)
+
+        return self._cholesky
+    def solve(self,b):
+        '''
+            Solve C.x = b, b being one vector or an array n x n_vectors
+        '''
+
+        return sp.linalg.cho_solve_banded((self.cholesky(),False),b,check_finite=False)
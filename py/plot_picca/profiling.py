@@ -0,0 +1,238 @@
+### Python lib
+import os
+import sys
+import json
+import time
+import resource
+import functools
+import tracemalloc
+import contextlib
+
+### Stages are only recorded if enabled, by the environment variable
+### PLOT_PICCA_PROFILE (path of the log, one JSON record per line) or by profile().
+### The allocations are only traced if memory, by PLOT_PICCA_PROFILE_MEMORY=1
+### or profile(memory=True), since tracing slows down the stages
+_enabled = False
+_memory  = False
+_records = None
+_log     = None
+_stack   = []
+_tracing = False
+
+class _NullStage:
+    '''
+        Stage doing nothing, returned when the profiling is disabled
+    '''
+
+    def __enter__(self):
+        return self
+    def __exit__(self,*args):
+        return False
+    def add(self,**info):
+        return
+
+_null_stage = _NullStage()
+
+def get_max_rss():
+    '''
+        Maximum resident set size of the process so far, in bytes
+    '''
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform!='darwin':
+        rss *= 1024
+
+    return rss
+def get_bytes_read():
+    '''
+        Bytes read by the process so far, from /proc/self/io,
+        None if not available
+    '''
+
+    try:
+        with open('/proc/self/io') as f:
+            for l in f:
+                if l.startswith('rchar:'):
+                    return int(l.split()[1])
+    except (IOError,OSError):
+        return None
+
+    return None
+
+class _Stage:
+    '''
+        Wall time, bytes read and maximum resident set size at the end
+        of a stage, and if the memory is traced, peak of the memory
+        allocated during the stage
+    '''
+
+    def __init__(self,name,info):
+
+        self._name = name
+        self._info = info
+
+        return
+
+    def __enter__(self):
+
+        global _tracing
+        self._children_peak = 0
+        if _memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _tracing = True
+            current, peak = tracemalloc.get_traced_memory()
+            self._memory = current
+            ### Keep the peak of the parent before resetting it
+            if len(_stack)>0:
+                _stack[-1]._children_peak = max(_stack[-1]._children_peak,peak)
+            if hasattr(tracemalloc,'reset_peak'):
+                tracemalloc.reset_peak()
+        self._bytes = get_bytes_read()
+        self._parent = _stack[-1]._name if len(_stack)>0 else None
+        _stack.append(self)
+        self._time = time.time()
+
+        return self
+    def __exit__(self,*args):
+
+        dt = time.time()-self._time
+        bytes_read = get_bytes_read()
+        if bytes_read is not None and self._bytes is not None:
+            bytes_read -= self._bytes
+        _stack.pop()
+        peak_bytes = None
+        if _memory and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1],self._children_peak)
+            peak_bytes = peak-self._memory
+            if len(_stack)>0:
+                _stack[-1]._children_peak = max(_stack[-1]._children_peak,peak)
+
+        record = {
+            'stage'      : self._name,
+            'parent'     : self._parent,
+            'depth'      : len(_stack),
+            'time'       : dt,
+            'bytes_read' : bytes_read,
+            'max_rss'    : get_max_rss(),
+            'peak_bytes' : peak_bytes,
+            'pid'        : os.getpid(),
+        }
+        record.update(self._info)
+        emit(record)
+
+        return False
+    def add(self,**info):
+        '''
+            Add information to the record of the stage
+        '''
+
+        self._info.update(info)
+
+        return
+
+def stage(name,**info):
+    '''
+        Context manager recording the stage name (open, read columns,
+        reduce, project, render, ...), with the extra information info
+    '''
+
+    if not _enabled:
+        return _null_stage
+
+    return _Stage(name,info)
+def staged(name):
+    '''
+        Decorator recording each call of the function as the stage name
+    '''
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args,**kwargs):
+            if not _enabled:
+                return func(*args,**kwargs)
+            with _Stage(name,{'function':func.__qualname__}):
+                return func(*args,**kwargs)
+        return wrapper
+
+    return decorator
+def emit(record):
+
+    if _records is not None:
+        _records.append(record)
+    if _log is not None:
+        with open(_log,'a') as f:
+            f.write(json.dumps(record)+'\n')
+
+    return
+def enable(log=None,memory=False):
+    '''
+        Record the stages, appended to the file log if given,
+        and trace the allocations if memory
+    '''
+
+    global _enabled, _log, _memory
+
+    _enabled = True
+    _log = log
+    _memory = memory
+
+    return
+def disable():
+
+    global _enabled, _log, _memory, _tracing
+
+    _enabled = False
+    _log = None
+    _memory = False
+    if _tracing:
+        tracemalloc.stop()
+        _tracing = False
+
+    return
+@contextlib.contextmanager
+def profile(log=None,memory=False):
+    '''
+        Record the stages run in the block, yield the list of records,
+        also appended to the file log if given.
+        If memory, trace the allocations, which slows down the stages
+    '''
+
+    global _records
+
+    previous = (_enabled,_log,_memory,_records)
+    _records = []
+    enable(log,memory)
+    try:
+        yield _records
+    finally:
+        _records = previous[3]
+        if previous[0]:
+            if previous[2]==False and _tracing:
+                disable()
+            enable(previous[1],previous[2])
+        else:
+            disable()
+
+    return
+def summary(records):
+    '''
+        Total time, bytes read, and maximum resident set size and
+        peak of each stage
+    '''
+
+    summary = {}
+    for r in records:
+        s = summary.setdefault(r['stage'],{'calls':0,'time':0.,'bytes_read':0,'max_rss':0,'peak_bytes':None})
+        s['calls'] += 1
+        s['time']  += r['time']
+        if r['bytes_read'] is not None:
+            s['bytes_read'] += r['bytes_read']
+        s['max_rss'] = max(s['max_rss'],r['max_rss'])
+        if r['peak_bytes'] is not None:
+            s['peak_bytes'] = max(s['peak_bytes'] or 0,r['peak_bytes'])
+
+    return summary
+
+if 'PLOT_PICCA_PROFILE' in os.environ:
+    enable(os.environ['PLOT_PICCA_PROFILE'],os.environ.get('PLOT_PICCA_PROFILE_MEMORY','0')=='1')
@@ -0,0 +1,123 @@
+### Python lib
+import scipy as sp
+import scipy.sparse
+import scipy.special
+
+### Projection matrices, for each geometry
+_cache = {}
+
+def get_subsample_grid(rpmin,rpmax,nrp,rtmin,rtmax,nrt,ss=10):
+    '''
+        Centers of the ss x ss sub-bins of each (rp,rt) bin,
+        and index of the (rp,rt) bin of each sub-bin
+    '''
+
+    nrtmc = ss*nrt
+    nrpmc = ss*nrp
+    index = sp.arange(nrtmc*nrpmc)
+    irtmc = index%nrtmc
+    irpmc = index//nrtmc
+    rtmc  = rtmin+(irtmc+0.5)*(rtmax-rtmin)/nrtmc
+    rpmc  = rpmin+(irpmc+0.5)*(rpmax-rpmin)/nrpmc
+    bins  = irtmc//ss + nrt*(irpmc//ss)
+
+    return rpmc, rtmc, bins
+def get_r(rmin,rmax,nr):
+    '''
+        Centers of the bins in r
+    '''
+
+    return rmin+(sp.arange(nr)+0.5)*(rmax-rmin)/nr
+def get_multipole_matrix(rpmin,rpmax,nrp,rtmin,rtmax,nrt,rmin,rmax,nr,ells=(0,2,4),ss=10):
+    '''
+        Sparse matrix (len(ells)*nr x nrp*nrt) projecting a correlation
+        on the (rp,rt) grid to its Legendre multipoles in bins of r.
+        The sub-bins are weighted by their volume, proportional to rt,
+        so that mu is uniformly sampled in each shell.
+        Cached for each geometry
+    '''
+
+    key = ('multipole',rpmin,rpmax,nrp,rtmin,rtmax,nrt,rmin,rmax,nr,tuple(ells),ss)
+    if key in _cache:
+        return _cache[key]
+
+    rpmc, rtmc, bins = get_subsample_grid(rpmin,rpmax,nrp,rtmin,rtmax,nrt,ss)
+    rmc  = sp.sqrt(rpmc**2+rtmc**2)
+    w    = (rmc>=rmin) & (rmc<rmax)
+    rmc  = rmc[w]
+    mumc = rpmc[w]/rmc
+    vol  = rtmc[w]
+    bins = bins[w]
+    br   = ((rmc-rmin)/(rmax-rmin)*nr).astype(int)
+
+    norm = sp.bincount(br,weights=vol,minlength=nr)
+    vol /= norm[br]
+
+    rows = sp.concatenate([ i*nr+br for i in range(len(ells)) ])
+    cols = sp.concatenate([ bins for i in range(len(ells)) ])
+    vals = sp.concatenate([ (2.*ell+1.)*sp.special.eval_legendre(ell,mumc)*vol for ell in ells ])
+    mat  = sp.sparse.coo_matrix((vals,(rows,cols)),shape=(len(ells)*nr,nrp*nrt)).tocsr()
+
+    _cache[key] = mat
+
+    return mat
+def get_wedge_matrix(rpmin,rpmax,nrp,rtmin,rtmax,nrt,rmin,rmax,nr,mumin,mumax,ss=10,absoluteMu=False):
+    '''
+        Sparse matrix (nr x nrp*nrt) counting the sub-bins of each (rp,rt) bin
+        in each bin of r, for mumin <= mu <= mumax, as picca.wedgize.
+        Cached for each geometry and range of mu
+    '''
+
+    key = ('wedge',rpmin,rpmax,nrp,rtmin,rtmax,nrt,rmin,rmax,nr,mumin,mumax,ss,absoluteMu)
+    if key in _cache:
+        return _cache[key]
+
+    rpmc, rtmc, bins = get_subsample_grid(rpmin,rpmax,nrp,rtmin,rtmax,nrt,ss)
+    rmc  = sp.sqrt(rpmc**2+rtmc**2)
+    mumc = rpmc/rmc
+    if absoluteMu:
+        mumc = sp.absolute(mumc)
+
+    w    = (mumc>=mumin) & (mumc<=mumax) & (rmc<rmax) & (rmc>=rmin)
+    bins = bins[w]
+    br   = ((rmc[w]-rmin)/(rmax-rmin)*nr).astype(int)
+    mat  = sp.sparse.coo_matrix((sp.ones(br.size),(br,bins)),shape=(nr,nrp*nrt)).tocsr()
+
+    _cache[key] = mat
+
+    return mat
+def get_rebin_matrix(np,nt,factor_p,factor_t):
+    '''
+        Sparse matrix (np*nt/(factor_p*factor_t) x np*nt) summing the
+        bins of a grid of np x nt bins into a grid coarser by factor_p
+        along rp and factor_t along rt.
+        Cached for each geometry
+    '''
+
+    key = ('rebin',np,nt,factor_p,factor_t)
+    if key in _cache:
+        return _cache[key]
+
+    assert(np%factor_p==0 and nt%factor_t==0)
+
+    index = sp.arange(np*nt)
+    bins  = (index//nt//factor_p)*(nt//factor_t) + (index%nt)//factor_t
+    mat   = sp.sparse.coo_matrix((sp.ones(index.size),(bins,index)),shape=(np*nt//(factor_p*factor_t),np*nt)).tocsr()
+
+    _cache[key] = mat
+
+    return mat
+def get_weighted_rebin_matrix(np,nt,factor_p,factor_t,we):
+    '''
+        Sparse matrix averaging the merged bins with the weights we,
+        see get_rebin_matrix. Return it and the sum of the weights
+        of each new bin
+    '''
+
+    mat = get_rebin_matrix(np,nt,factor_p,factor_t)
+    sum_we = mat.dot(we)
+    norm = sp.zeros(sum_we.size)
+    w = (sum_we>0.)
+    norm[w] = 1./sum_we[w]
+
+    return sp.sparse.diags(norm).dot(mat.dot(sp.sparse.diags(we))).tocsr(), sum_we
@@ -0,0 +1,98 @@
+### Python lib
+import os
+import importlib
+import multiprocessing
+
+from . import profiling
+
+def _init_worker(backend):
+    '''
+        Select the non-interactive backend of matplotlib in a worker
+    '''
+
+    import matplotlib
+    matplotlib.use(backend)
+    import matplotlib.pyplot as plt
+    plt.switch_backend(backend)
+
+    return
+def get_object(job):
+    '''
+        Object to plot of a job: job['obj'] if given, else an instance
+        of job['class'] ('module.Class', e.g. 'correlation_3D.Correlation3D')
+        built from the dictionary job['dic']
+    '''
+
+    if 'obj' in job.keys():
+        return job['obj']
+
+    module, name = job['class'].rsplit('.',1)
+    module = importlib.import_module('.'+module,__package__)
+
+    return getattr(module,name)(job['dic'])
+@profiling.staged('render')
+def render_job(job):
+    '''
+        Draw one job and save it to job['output'], the format (PNG, PDF, ...)
+        being given by the extension.
+        job['method'] is the name of the plotting method, called with
+        job['kwargs'] and the axes of a new figure. Methods drawing into
+        several axes take job['nb_axes']>1 and save one file per axes,
+        output_0.png, output_1.png, ...
+        Return the list of the written files
+    '''
+
+    import matplotlib.pyplot as plt
+
+    obj = get_object(job)
+    kwargs = job.get('kwargs',{})
+    nb_axes = job.get('nb_axes',1)
+    figsize = job.get('figsize',None)
+    dpi = job.get('dpi',None)
+
+    figs = [ plt.figure(figsize=figsize) for i in range(nb_axes) ]
+    axs = [ fig.add_subplot(111) for fig in figs ]
+    if nb_axes==1:
+        getattr(obj,job['method'])(ax=axs[0],**kwargs)
+        outputs = [job['output']]
+    else:
+        getattr(obj,job['method'])(axs=axs,**kwargs)
+        root, ext = os.path.splitext(job['output'])
+        outputs = [ root+'_'+str(i)+ext for i in range(nb_axes) ]
+
+    for fig, output in zip(figs,outputs):
+        directory = os.path.dirname(output)
+        if directory!='' and not os.path.isdir(directory):
+            os.makedirs(directory)
+        fig.savefig(output,dpi=dpi,bbox_inches='tight')
+        plt.close(fig)
+
+    return outputs
+def render(jobs,workers=1,backend='Agg'):
+    '''
+        Render the list of jobs (see render_job) without display,
+        with the non-interactive backend, over a pool of workers processes.
+        With one worker the jobs are rendered in this process, and its
+        backend is restored afterwards.
+        Return the list of the written files of each job
+    '''
+
+    if workers==1:
+        import matplotlib
+        import matplotlib.pyplot as plt
+        previous = matplotlib.get_backend()
+        _init_worker(backend)
+        try:
+            outputs = [ render_job(job) for job in jobs ]
+        finally:
+            plt.switch_backend(previous)
+        return outputs
+
+    pool = multiprocessing.Pool(processes=workers,initializer=_init_worker,initargs=(backend,))
+    try:
+        outputs = pool.map(render_job,jobs,chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    return outputs
@@ -0,0 +1,62 @@
+### Python lib
+import os
+import numpy
+import pytest
+
+from plot_picca import matrix, benchmark
+
+def test_diagonal_sums():
+
+    rng = numpy.random.RandomState(0)
+    mat = numpy.triu(rng.randn(7,7))
+    packed = matrix.pack(mat,nband=4)
+
+    expected = [ numpy.diagonal(mat,k).sum() for k in range(4) ]
+    numpy.testing.assert_allclose(packed.diagonal_sums(),expected)
+
+    return
+def test_read_from_do_cor(tmpdir):
+
+    pytest.importorskip('fitsio')
+    from plot_picca import correlation_1D
+
+    path = os.path.join(str(tmpdir),'cf1d.fits')
+    benchmark.write_do_cor_1d(path,50)
+    dic = { 'correlation':'f_f', 'f1':'LYA', 'f2':'LYA', 'lmin1':None, 'lmin2':None,
+        'title':'', 'path':path }
+
+    cor = correlation_1D.Correlation1D(dict(dic))
+    blocks = correlation_1D.Correlation1D(dict(dic,block_size=16))
+
+    assert cor._cor.shape==(50,4)
+    numpy.testing.assert_allclose(cor._cor,blocks._cor)
+    numpy.testing.assert_allclose(cor._var,blocks._var)
+
+    return
+@pytest.mark.parametrize('n1d',[1,7,200,1000,2000,3000,10000])
+def test_get_grid_1d(n1d):
+
+    from plot_picca import correlation_1D
+
+    cor = correlation_1D.Correlation1D.__new__(correlation_1D.Correlation1D)
+    cor.set_grid(benchmark.get_grid_1d(n1d))
+
+    assert cor._n1d==n1d
+
+    return
+@pytest.mark.parametrize('n1d',[1,7,200])
+def test_write_do_cor_1d_grid(tmpdir,n1d):
+
+    fitsio = pytest.importorskip('fitsio')
+    from plot_picca import correlation_1D
+
+    path = os.path.join(str(tmpdir),'cf1d.fits')
+    benchmark.write_do_cor_1d(path,n1d)
+
+    cor = correlation_1D.Correlation1D({ 'correlation':'f_f', 'f1':'LYA', 'f2':'LYA',
+        'lmin1':None, 'lmin2':None, 'title':'', 'path':path })
+
+    assert cor._n1d==n1d
+    assert cor._var.shape==(n1d,4)
+
+    return
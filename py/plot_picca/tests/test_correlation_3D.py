@@ -0,0 +1,52 @@
+### Python lib
+import os
+import numpy
+import pytest
+
+from plot_picca import benchmark
+
+fitsio = pytest.importorskip('fitsio')
+
+def get_do_cor(tmpdir,n_healpix=20,np=4,nt=5):
+
+    from plot_picca import correlation_3D
+
+    path = os.path.join(str(tmpdir),'cf.fits')
+    benchmark.write_do_cor(path,n_healpix,np,nt)
+    dic = { 'correlation':'f_f', 'f1':'LYA', 'f2':'LYA', 'o1':None, 'o2':None,
+        'l1':None, 'l2':None, 'title':'', 'nside':16, 'read':'read_from_do_cor', 'path':path }
+
+    return correlation_3D.Correlation3D(dic)
+@pytest.mark.parametrize('method',['subsample','jackknife','bootstrap'])
+def test_compute_covariance(tmpdir,method):
+
+    cor = get_do_cor(tmpdir)
+    cov = cor.compute_covariance(method=method,nboot=200,seed=1,block_size=7)
+
+    assert cov.shape==(20,20)
+    assert numpy.isfinite(cov).all()
+    numpy.testing.assert_allclose(cov,cov.T,atol=1.e-15)
+    assert (numpy.diagonal(cov)>0.).all()
+    numpy.testing.assert_allclose(cor._er,numpy.sqrt(numpy.diagonal(cov)))
+
+    return
+def test_compute_covariance_bootstrap_seed(tmpdir):
+
+    cor = get_do_cor(tmpdir)
+    cov1 = cor.compute_covariance(method='bootstrap',nboot=100,seed=3).copy()
+    cov2 = cor.compute_covariance(method='bootstrap',nboot=100,seed=3,block_size=3)
+
+    ### Same resamplings whatever the blocks of rows
+    numpy.testing.assert_allclose(cov1,cov2)
+
+    return
+def test_distortion_matrix_missing(tmpdir):
+
+    cor = get_do_cor(tmpdir)
+
+    with pytest.raises(ValueError):
+        cor.get_distortion_matrix()
+    with pytest.raises(ValueError):
+        cor.distort(numpy.zeros(cor._da.size))
+
+    return
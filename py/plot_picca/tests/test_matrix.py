@@ -0,0 +1,23 @@
+### Python lib
+import numpy
+import pytest
+
+from plot_picca import matrix, utils
+
+@pytest.mark.parametrize('max_dp,max_dt',[(0,0),(1,2),(2,4),(None,None)])
+def test_correlation_diagonal(max_dp,max_dt):
+
+    np, nt = 4, 5
+    rng = numpy.random.RandomState(0)
+    a = rng.randn(np*nt,2*np*nt)
+    cov = a.dot(a.T)
+    ### A bin with a null variance
+    cov[7,:] = 0.
+    cov[:,7] = 0.
+
+    compact = matrix.compress([(0,cov)],np,nt,max_dp,max_dt)
+    cor = utils.getCorrelationMatrix(compact.dense())
+    for k in range(np*nt+1):
+        numpy.testing.assert_allclose(compact.correlation_diagonal(k),numpy.diag(cor,k=k))
+
+    return
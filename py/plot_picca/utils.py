@@ -1,7 +1,35 @@
+import os
+import importlib
+import collections.abc
 import scipy as sp
 import scipy.constants
-from . import constants
+import scipy.sparse
+from . import constants, profiling, matrix
 
+class LazyModule:
+    '''
+        Module imported on first access to one of its attributes,
+        to keep the heavy dependencies (matplotlib, fitsio, h5py)
+        out of the import of the package
+    '''
+
+    def __init__(self,name):
+
+        self._name   = name
+        self._module = None
+
+        return
+
+    def __getattr__(self,attr):
+
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+
+        return getattr(self._module,attr)
+
+### Heavy dependencies
+fitsio = LazyModule('fitsio')
+plt    = LazyModule('matplotlib.pyplot')
 
 def croom(x):
     '''
@@ -56,24 +84,278 @@ def convert1DTo2D(array1D,nbX,nbY):
         array2D[i][j] = array1D[k]
 
     return array2D
-def getCorrelationMatrix(cov):
+def getCorrelationMatrix(cov,inplace=False,out=None,block_size=None):
     '''
-        Get the correlation matrix from a covaraince matrix
+        Get the correlation matrix from a covaraince matrix.
+        Rows and columns with a null variance are set to zero.
+        The result is written in cov itself if inplace, in out if given
+        (e.g. a memory-mapped array), else in a new array, and returned.
+        If block_size is given, block_size rows are normalized at a time
+        with no temporary array, so that with inplace, or with out and cov
+        memory-mapped, only one block of rows is in memory at once
     '''
 
     ### Get normalisation factor
-    invSqrtDiag = sp.zeros(sp.diag(cov).size)
-    w = (sp.diag(cov)>0.)
-    invSqrtDiag[w] = 1./sp.sqrt(sp.diag(cov)[w])
+    diag = sp.array(sp.diag(cov))
+    invSqrtDiag = sp.zeros(diag.size)
+    w = (diag>0.)
+    invSqrtDiag[w] = 1./sp.sqrt(diag[w])
 
     ### Normalize
-    cor = sp.array(cov)
-    for i in range(cov[:,0].size):
-        cor[:,i] *= invSqrtDiag[i]
-        cor[i,:] *= invSqrtDiag[i]
-        if invSqrtDiag[i]>0.: cor[i,i] = 1.
+    if inplace:
+        out = cov
+    elif out is None:
+        out = sp.empty(cov.shape,dtype=sp.result_type(cov,invSqrtDiag))
+    if block_size is None:
+        block_size = max(diag.size,1)
+
+    for start in range(0,diag.size,block_size):
+        stop = min(start+block_size,diag.size)
+        block = out[start:stop]
+        sp.multiply(cov[start:stop],invSqrtDiag[start:stop,None],out=block)
+        block *= invSqrtDiag
+
+    idx = sp.arange(diag.size)[w]
+    out[idx,idx] = 1.
+
+    return out
+def get_axes(ax=None):
+    '''
+        Axes to draw into, and if the figure has to be shown:
+        ax if given, else the axes of a new figure
+    '''
+
+    if ax is not None:
+        return ax, False
+
+    fig = plt.figure()
+
+    return fig.add_subplot(111), True
+def show_axes(ax,show):
+    '''
+        Show the figure of ax if show, and return it
+    '''
+
+    if show:
+        plt.show()
+
+    return ax.figure
+def get_grid_header(head):
+    '''
+        Grid of the header of a correlation, with plain types,
+        as compared in the cache keys and the raw sums
+    '''
+
+    return { 'NT':int(head['NT']), 'NP':int(head['NP']), 'RTMAX':float(head['RTMAX']),
+        'RPMIN':float(head['RPMIN']), 'RPMAX':float(head['RPMAX']) }
+def iter_rows(hdu,columns,block_size=None):
+    '''
+        Iterate over the rows of a FITS table, block_size rows at a time.
+        Yield the index of the first row and a dictionary of the columns
+    '''
+
+    nrows = hdu.get_nrows()
+    if block_size is None:
+        block_size = max(nrows,1)
+
+    for start in range(0,nrows,block_size):
+        stop = min(start+block_size,nrows)
+        yield start, { c:hdu[c][start:stop] for c in columns }
+
+    return
+@profiling.staged('reduce')
+def reduce_healpix(hdu,read_da=True,block_size=None):
+    '''
+        Sum the per-HEALPix rows of a picca do_cor file.
+        Return the sum of the weights and of the weighted correlation.
+        If block_size is given, only block_size rows are in memory at once,
+        and the rows are summed in the same order as sum(axis=0)
+    '''
+
+    if block_size is None:
+        we = hdu['WE'][:]
+        sum_we = we.sum(axis=0)
+        sum_wda = None
+        if read_da:
+            da = hdu['DA'][:]
+            sum_wda = (da*we).sum(axis=0)
+        return sum_we, sum_wda
+
+    columns = ['WE']
+    if read_da:
+        columns += ['DA']
+
+    sum_we  = None
+    sum_wda = None
+    for _, block in iter_rows(hdu,columns,block_size):
+        we = block['WE']
+        if sum_we is None:
+            sum_we = sp.zeros(we.shape[1])
+            if read_da:
+                sum_wda = sp.zeros(we.shape[1])
+        for i in range(we.shape[0]):
+            sum_we += we[i]
+            if read_da:
+                sum_wda += block['DA'][i]*we[i]
+
+    return sum_we, sum_wda
+def sum_diagonals(mat,mat2=None,row_start=0,block_size=256):
+    '''
+        Sum of each diagonal of a square matrix, or of the element-wise
+        product mat*mat2. mat can also be a block of rows of the matrix,
+        starting at row row_start.
+        Return an array of size 2n-1, with the sum of the diagonal k=j-i
+        at index n-1+k
+    '''
+
+    nrow, n = mat.shape
+    sums = sp.zeros(2*n-1)
+
+    for start in range(0,nrow,block_size):
+        stop = min(start+block_size,nrow)
+        block = mat[start:stop]
+        if mat2 is not None:
+            block = block*mat2[start:stop]
+        idx = sp.arange(n) - (row_start+sp.arange(start,stop))[:,None] + n-1
+        sums += sp.bincount(idx.ravel(),weights=sp.ravel(block),minlength=2*n-1)
+
+    return sums
+def lazy_attribute(name):
+    '''
+        Attribute computed by calling self._loaders[name]() on first access.
+        Setting the attribute drops the loader
+    '''
+
+    def fget(self):
+        if name in self._loaders:
+            self.__dict__[name] = self._loaders.pop(name)()
+        return self.__dict__.get(name)
+    def fset(self,value):
+        self._loaders.pop(name,None)
+        self.__dict__[name] = value
+
+    return property(fget,fset)
+class LazyDict(collections.abc.MutableMapping):
+    '''
+        Dictionary whose values in loaders are only computed,
+        by calling loaders[key](), on first access
+    '''
+
+    def __init__(self,values=None,loaders=None):
+
+        self._values  = {}
+        self._loaders = {}
+        if values is not None:
+            self._values.update(values)
+        if loaders is not None:
+            self._loaders.update(loaders)
+
+        return
+
+    def __getitem__(self,key):
+
+        if key in self._loaders:
+            self._values[key] = self._loaders.pop(key)()
+
+        return self._values[key]
+    def __setitem__(self,key,value):
+
+        self._loaders.pop(key,None)
+        self._values[key] = value
+
+        return
+    def __delitem__(self,key):
+
+        if key in self._loaders:
+            del self._loaders[key]
+        else:
+            del self._values[key]
+
+        return
+    def __iter__(self):
+
+        for key in list(self._values.keys())+list(self._loaders.keys()):
+            yield key
+
+        return
+    def __len__(self):
+
+        return len(self._values)+len(self._loaders)
+    def set_loader(self,key,loader):
+
+        self._values.pop(key,None)
+        self._loaders[key] = loader
+
+        return
+    def is_loaded(self,key):
+
+        return key not in self._loaders
+@profiling.staged('read columns')
+def read_column(path,column,ext=1,sidecar=False):
+    '''
+        Read a column of a FITS table.
+        If sidecar, the column is saved next to the FITS file in a .npy file
+        and memory-mapped from it, now and on the next reads
+    '''
+
+    sidecar_path = path+'.'+column+'.npy'
+    if sidecar and os.path.isfile(sidecar_path) and os.path.getmtime(sidecar_path)>=os.path.getmtime(path):
+        return sp.load(sidecar_path,mmap_mode='r')
+
+    vac = fitsio.FITS(path)
+    data = vac[ext][column][:]
+    vac.close()
+
+    if sidecar:
+        try:
+            sp.save(sidecar_path,data)
+        except (IOError,OSError):
+            return data
+        del data
+        return sp.load(sidecar_path,mmap_mode='r')
+
+    return data
+@profiling.staged('read columns')
+def read_column_diagonal(path,column,ext=1,block_size=1024):
+    '''
+        Read the diagonal of a square matrix stored in a column of a FITS table,
+        block_size rows at a time
+    '''
+
+    vac = fitsio.FITS(path)
+    diag = []
+    for start, block in iter_rows(vac[ext],[column],block_size):
+        mat = block[column]
+        diag += [ mat[sp.arange(mat.shape[0]),start+sp.arange(mat.shape[0])] ]
+    vac.close()
+
+    return sp.concatenate(diag)
+@profiling.staged('read columns')
+def read_column_sparse(path,column,ext=1,block_size=1024):
+    '''
+        Read a matrix stored in a column of a FITS table as a sparse
+        CSR matrix, block_size rows at a time
+    '''
+
+    vac = fitsio.FITS(path)
+    mat = [ sp.sparse.csr_matrix(block[column]) for start, block in iter_rows(vac[ext],[column],block_size) ]
+    vac.close()
+
+    return sp.sparse.vstack(mat).tocsr()
+@profiling.staged('read columns')
+def read_offset_covariance(path,column,np,nt,max_dp=None,max_dt=None,ext=1,block_size=1024):
+    '''
+        Read a covariance stored in a column of a FITS table in its compact
+        form keyed by (Delta rp, Delta rt), see matrix.compress,
+        block_size rows at a time
+    '''
+
+    vac = fitsio.FITS(path)
+    rows = ( (start,block[column]) for start, block in iter_rows(vac[ext],[column],block_size) )
+    co = matrix.compress(rows,np,nt,max_dp,max_dt)
+    vac.close()
 
-    return cor
+    return co
 def get_precision(error,nb_diggit=2):
 
     precision = int( nb_diggit -1 -sp.floor( sp.log10(error) ) )